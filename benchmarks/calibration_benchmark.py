@@ -0,0 +1,39 @@
+"""Microbenchmark of converting raw ADC readings with a calibration table.
+
+Run from the repository root:
+
+    python -m benchmarks.calibration_benchmark
+
+"""
+import random
+import timeit
+
+from utils.calibration import adc_codes, two_point
+
+# Number of conversions timed per method
+iterations = 100000
+
+# Raw readings of the soil humidity sensors in sensor_config.yaml
+wet_value, dry_value = 80, 143
+
+
+def linear_map(raw_reading):
+    """Convert a reading with the float map, clamp and round each reading used to compute."""
+    result = (1 - (raw_reading - wet_value) / (dry_value - wet_value)) * 100
+    return round(max(min(result, 100), 0), 2)
+
+
+if __name__ == "__main__":
+    calibration = two_point(wet_value, 100, dry_value, 0)
+    readings = [random.uniform(0, adc_codes - 1) for _ in range(iterations)]
+    results = {
+        "linear map": timeit.timeit(
+            lambda: [linear_map(raw) for raw in readings], number=1),
+        "table": timeit.timeit(
+            lambda: [calibration.convert(raw) for raw in readings], number=1),
+        "table batch": timeit.timeit(
+            lambda: calibration.convert_batch(readings), number=1)
+    }
+    print(f"{'method':<14}{'ns per reading':>16}")
+    for method, seconds in results.items():
+        print(f"{method:<14}{seconds / iterations * 1e9:>16.1f}")
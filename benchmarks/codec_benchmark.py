@@ -0,0 +1,32 @@
+"""Microbenchmark of the sample payload codecs.
+
+Run from the repository root:
+
+    python -m benchmarks.codec_benchmark
+
+"""
+import timeit
+from datetime import datetime as dt
+
+from utils.payload_codecs import codecs
+
+# Number of encode and decode calls timed per codec
+iterations = 100000
+
+
+def benchmark(codec, sample):
+    """Return the payload size and encode/decode time per call in microseconds."""
+    payload = codec.encode_sample(sample)
+    encode = timeit.timeit(
+        lambda: codec.encode_sample(sample), number=iterations)
+    decode = timeit.timeit(
+        lambda: codec.decode_sample(payload), number=iterations)
+    return len(payload), encode / iterations * 1e6, decode / iterations * 1e6
+
+
+if __name__ == "__main__":
+    sample = {"value": 56.23, "timestamp": dt.now()}
+    print(f"{'codec':<10}{'bytes':>8}{'encode us':>12}{'decode us':>12}")
+    for name, codec in codecs.items():
+        size, encode, decode = benchmark(codec, sample)
+        print(f"{name:<10}{size:>8}{encode:>12.2f}{decode:>12.2f}")
@@ -5,69 +5,109 @@ well as the automation of watering events.
 
 """
 import json
+import os
+import signal
+import socket
+import threading
 from datetime import datetime as dt
 
 import paho.mqtt.client as mqtt
 from sqlalchemy import select
 
-from utils.common import connection_message, parse_json_payload
-from utils.db_interaction import (create_plant, create_sample, create_sensor,
-                                  create_watering_event, engine, initialize_db,
-                                  plant_table, sensor_table, watering_table)
-from utils.logging import mqtt_logger, sample_logger
-
-# Create all of the schema objects in the database and create the engine.
-initialize_db()
+from utils.calibration import calibration
+from utils.common import (connection_message, parse_json_payload,
+                          run_periodically)
+from utils.cooldown_tracker import cooldown_tracker
+from utils.db_interaction import (create_plant, create_plants, create_sensor,
+                                  create_watering_event, engine, pool_stats,
+                                  sensor_table, update_sensor)
+from utils.leader_election import leader_election
+from utils.logging import config_logger, mqtt_logger, sample_logger
+from utils.metadata_cache import metadata_cache
+from utils.migrations import migrate
+from utils.partitions import ensure_sample_partitions
+from utils.payload_codecs import parse_batch_topic, parse_sample_topic
+from utils.qos_policy import qos
+from utils.retention import enforce_retention, read_policies
+from utils.sample_writer import sample_writer
+from utils.sequence_tracker import sequence_tracker
+from utils.work_queue import partitioned_worker_pool
+
+# Bring the database schema up to date.
+migrate()
+
+# Sensor and plant metadata, loaded once and kept current from config messages
+cache = metadata_cache()
+cache.load()
+
+# Last watering time of every plant, loaded once and kept current from pump events
+cooldowns = cooldown_tracker()
+cooldowns.load()
 
 # IP for the MQTT broker
 broker_ip = ""
 
-# Create an MQTT client object
-client = mqtt.Client("garden_manager")
+# Number of manager replicas splitting ingest and the index of this replica
+replica_count = int(os.environ.get("MANAGER_REPLICAS", 1))
+replica_index = int(os.environ.get("MANAGER_REPLICA_INDEX", 0))
+
+# Advisory lock key that replicas compete for to become the leader
+leader_lock_id = 0x6761726465
+
+# Election deciding which replica makes watering decisions, None with a single replica
+election = None
+
+# Lease making this replica the only active consumer of its partition, None with a single replica
+partition_lease = None
+
+# Whether garden_monitor makes watering decisions from plants/rules, or the manager does
+edge_watering = os.environ.get("WATERING_MODE", "edge") == "edge"
+
+# Create an MQTT client object, replicas need unique client ids
+client = mqtt.Client(
+    "garden_manager" if replica_count == 1 else f"garden_manager_{replica_index}_{socket.gethostname()}")
 
+# Buffered writer that batches incoming samples into multi-row inserts
+ingest_writer = sample_writer(
+    batch_size=int(os.environ.get("INGEST_BATCH_SIZE", 100)),
+    max_latency=float(os.environ.get("INGEST_MAX_LATENCY", 1.0)),
+    max_buffered=int(os.environ.get("INGEST_MAX_BUFFERED", 100000))
+)
 
-def check_plants():
+# Sequence numbers of every sensor's samples, used to drop duplicates and count gaps
+sequences = sequence_tracker()
+
+# Set on SIGTERM, after which incoming messages are ignored while the queues drain
+stopping = threading.Event()
+
+# Worker pool that handles messages off of paho's network thread
+workers = partitioned_worker_pool(
+    workers=int(os.environ.get("MANAGER_WORKERS", 4)),
+    max_depth=int(os.environ.get("MANAGER_QUEUE_DEPTH", 1000)),
+    backpressure=os.environ.get("MANAGER_BACKPRESSURE", "block"),
+    block_timeout=float(os.environ.get("MANAGER_BLOCK_TIMEOUT", 1.0))
+)
+
+# Partition key of all sensor and plant config handling, so config messages
+# and plant reconciliation run one at a time and in order
+config_partition = "config"
+
+
+def reconcile_plants():
     """Check that every soil_humidity sensor has a plant associated with it.
 
-    If there exists a soil_humidity sensor that does not have a plant associated,
-    create a new plant with default values in the DB.
+    If there exist soil_humidity sensors that do not have a plant associated,
+    create new plants with default values in the DB in a single transaction.
+    This only needs to run when the set of sensors changes.
     """
-    with engine.connect() as conn:
-        plant_ids = conn.execute(
-            select(plant_table.c.id)
-        ).fetchall()
-        # Convert list of tuples into list of ids.
-        plant_ids = [id for id, in plant_ids]
-
-        associated_sensor_ids = conn.execute(
-            select(plant_table.c.humidity_sensor_id)
-        ).fetchall()
-        associated_sensor_ids = [id for id, in associated_sensor_ids]
-
-        humidity_sensors = conn.execute(
-            select(sensor_table.c.id).where(
-                sensor_table.c.type == 'soil_humidity')
-        ).fetchall()
-        humidity_sensors = [id for id, in humidity_sensors]
-
-        # now we have all plants and soil humidity sensors
-        for humidity_sensor_id in humidity_sensors:
-            # Create plants for every humidity sensor
-            if humidity_sensor_id not in associated_sensor_ids:
-                # Plant with default values
-                create_plant({
-                    # plant_ids is combined with single-element list to prevent max([])
-                    "name": f"plant_{max(plant_ids + [0]) + 1}",
-                    "humidity_sensor_id": humidity_sensor_id,
-                    "pump_id": max(plant_ids + [0]) + 1,
-                    "target": 50,
-                    "watering_cooldown": 300,
-                    "watering_duration": 1,
-                    "humidity_tolerance": 5
-                })
-                # Recursive call so we don't have to keep track of generated ids
-                check_plants()
-                return
+    new_plants = cache.missing_plants()
+    if new_plants:
+        create_plants(new_plants)
+        for plant in new_plants:
+            cache.update_plant(plant)
+        mqtt_logger.info(
+            f"Created default plants for sensor_ids {[plant['humidity_sensor_id'] for plant in new_plants]}")
+        publish_plant_rules()
 
 
 def check_watering(msg):
@@ -84,27 +124,20 @@ def check_watering(msg):
                     value: <value>
                 }
     """
-    # Ensure that all humidity_sensors have an associated plant object.
-    check_plants()
-
-    # Select data on the plant for the given soil_humidity sensor_id
-    with engine.connect() as conn:
-        plant_info = conn.execute(
-            select(plant_table).
-            where(plant_table.c.humidity_sensor_id == msg["sensor_id"])
-        ).first()
-
-    id, name, hum_sensor_id, pump_id, target, cooldown, duration, tolerance = plant_info
-
-    with engine.connect() as conn:
-        last_watering_event = conn.execute(
-            select(watering_table)
-            .where(watering_table.c.plant_id == id)
-            .order_by(watering_table.c.timestamp.desc())
-        ).fetchone()
+    # Look up the plant for the given soil_humidity sensor_id
+    plant_info = cache.plant_for_sensor(msg["sensor_id"])
+    if plant_info is None:
+        return
+
+    id = plant_info["id"]
+    pump_id = plant_info["pump_id"]
+    target = plant_info["target"]
+    cooldown = plant_info["watering_cooldown"]
+    duration = plant_info["watering_duration"]
+    tolerance = plant_info["humidity_tolerance"]
 
     # Check if plant has never been watered or if last time watered is longer than cooldown
-    if (not last_watering_event or (msg["timestamp"] - last_watering_event["timestamp"]).total_seconds() > cooldown):
+    if cooldowns.ready(id, msg["timestamp"], cooldown):
         # Check if the soil humidity is less than target - tolerance
         if (msg["value"] < target - tolerance):
             payload = {
@@ -113,36 +146,52 @@ def check_watering(msg):
             mqtt_logger.info(
                 f"Published to pumps/control/{pump_id}: {json.dumps(payload, indent=4)}")
             client.publish(
-                f"pumps/control/{pump_id}", payload=json.dumps(payload), qos=2)
+                f"pumps/control/{pump_id}", payload=json.dumps(payload),
+                qos=qos("pumps/control/+"))
 
 
 def handle_pumps_control(client, userdata, msg):
-    """Log a watering event in the database."""
+    """Start the plant's cooldown as soon as a pump command is sent.
+
+    The watering event itself is logged from pumps/event once the pump has run.
+    """
     payload = parse_json_payload(msg)
     mqtt_logger.info(
-        f"Received pump event for pump_id {msg.topic.split('/')[-1]}: {json.dumps(payload, indent=4)}")
+        f"Received pump command for pump_id {msg.topic.split('/')[-1]}: {json.dumps(payload, indent=4)}")
 
-    with engine.connect() as conn:
-        result = conn.execute(
-            select(plant_table.c.id).where(
-                plant_table.c.id == int(msg.topic.split("/")[-1])
-            )
-        )
-        plant_id = result.fetchone()[0]
-    payload.update(
-        {
-            "timestamp": dt.now(),
-            "plant_id": plant_id
-        }
-    )
-    create_watering_event(payload)
+    plant = cache.plant(msg.topic.split("/")[-1])
+    if plant and payload.get("action", "run") != "cancel":
+        cooldowns.record(plant["id"], dt.now())
+
+
+def handle_pumps_event(client, userdata, msg):
+    """Log a watering event in the database when garden_monitor reports a pump run."""
+    payload = parse_json_payload(msg)
+    mqtt_logger.info(
+        f"Received pump event for pump_id {payload['pump_id']}: {json.dumps(payload, indent=4)}")
+
+    plant = cache.plant(payload["pump_id"])
+    if plant is None:
+        return
+    started = dt.fromisoformat(payload["started"])
+    if is_leader():
+        create_watering_event({
+            "plant_id": plant["id"],
+            "timestamp": started,
+            "duration": round(payload["duration"])
+        })
+    cooldowns.record(plant["id"], started)
 
 
 def handle_plants_config(client, userdata, msg):
     """Update the DB to save plant configs."""
     payload = parse_json_payload(msg)
     mqtt_logger.info(f"Received plant config: {json.dumps(payload, indent=4)}")
-    create_plant(payload)
+    if is_leader():
+        create_plant(payload)
+    cache.update_plant(payload)
+    if is_leader():
+        publish_plant_rules()
 
 
 def handle_sensors_config(client, userdata, msg):
@@ -156,87 +205,367 @@ def handle_sensors_config(client, userdata, msg):
             "sample_gap": int(payload["sample_gap"])
         }
     )
-    create_sensor(payload)
-    publish_sensor_info()
+    # Optional reporting and adaptive sampling settings, None when unset
+    for key, cast in [("deadband", float), ("heartbeat", int), ("min_gap", int),
+                      ("max_gap", int), ("rate_threshold", float)]:
+        if payload.get(key) is not None:
+            payload[key] = cast(payload[key])
+    # An invalid calibration would be republished on the retained sensors/info.
+    if payload.get("calibration") is not None:
+        try:
+            calibration(payload["calibration"])
+        except (ValueError, TypeError) as error:
+            config_logger.error(
+                f"Ignored the calibration of sensor_id {payload['id']}: {error}")
+            payload["calibration"] = None
+    is_new = cache.sensor(payload["id"]) is None
+    cache.update_sensor(payload)
+    if is_new and replica_count > 1 and owns_sensor(payload["id"]) and partition_active():
+        client.subscribe(data_subscription(payload["id"]),
+                         qos=qos("sensors/data/#"))
+
+    if is_leader():
+        create_sensor(payload)
+        # A new soil_humidity sensor needs a plant.
+        reconcile_plants()
+        publish_sensor_info()
 
 
 def handle_sensors_data(client, userdata, msg):
     """Log received data into the DB as a new data sample."""
-    payload = parse_json_payload(msg)
+    sensor_id, codec = parse_sample_topic(msg.topic)
+    payload = codec.decode_sample(msg.payload)
+    if not sequences.check(sensor_id, payload.pop("seq", None)):
+        sample_logger.debug(f"Dropped duplicate sample from sensor_id {sensor_id}")
+        return
     sample_logger.info(
-        f"Received {payload['value']} from sensor_id {msg.topic.split('/')[-1]}")
+        f"Received {payload['value']} from sensor_id {sensor_id}")
 
-    payload.update(
-        {
-            "sensor_id": msg.topic.split("/")[-1],
-            "timestamp": dt.fromisoformat(payload["timestamp"])
-        }
-    )
+    payload["sensor_id"] = sensor_id
 
-    create_sample(payload)
+    ingest_writer.add(payload)
+    route_watering_check(payload)
 
-    with engine.connect() as conn:
-        result = conn.execute(
-            select(sensor_table.c.type)
-            .where(sensor_table.c.id == payload["sensor_id"])
-        ).fetchone()
 
-    if result[0] == "soil_humidity":
-        # Check if the plant needs to be watered
-        check_watering(payload)
+def handle_sensors_status(client, userdata, msg):
+    """Record the sample gap garden_monitor reports for a sensor on sensors/status/{id}."""
+    sensor_id = int(msg.topic.split("/")[-1])
+    payload = parse_json_payload(msg)
+    if payload.get("status") == "fault":
+        mqtt_logger.warning(
+            f"Sensor {sensor_id} reported a fault: {payload.get('error')}")
+    sensor = cache.sensor(sensor_id)
+    gap = payload.get("sample_gap")
+    if sensor is None or gap is None or sensor.get("effective_gap") == gap:
+        return
+    cache.update_sensor({"id": sensor_id, "effective_gap": gap})
+    mqtt_logger.info(f"Sensor {sensor_id} now samples every {gap} s")
+    if is_leader():
+        update_sensor(sensor_id, {"effective_gap": gap})
+
+
+def handle_sensors_batch(client, userdata, msg):
+    """Log a batch of samples from several sensors in a single transaction.
+
+    Every replica receives every batch and keeps the samples of the sensors it owns.
+    """
+    samples = [
+        sample for sample in parse_batch_topic(msg.topic).decode_batch(msg.payload)
+        if owns_sensor(sample["sensor_id"])
+        and sequences.check(sample["sensor_id"], sample.pop("seq", None))
+    ]
+    if not samples:
+        return
+    sample_logger.info(f"Received batch of {len(samples)} samples")
+
+    ingest_writer.write_batch(samples)
+    for sample in samples:
+        route_watering_check(sample)
+
+
+def route_watering_check(sample):
+    """Check watering for soil_humidity samples, or forward them to the leader.
+
+    Nothing is checked when garden_monitor waters by the plant rules itself.
+    """
+    if edge_watering:
+        return
+    sensor = cache.sensor(sample["sensor_id"])
+    if sensor and sensor["type"] == "soil_humidity":
+        if is_leader():
+            # Check if the plant needs to be watered
+            check_watering(sample)
+        else:
+            # Only the leader makes watering decisions.
+            client.publish("garden_manager/watering", payload=json.dumps({
+                "sensor_id": sample["sensor_id"],
+                "timestamp": sample["timestamp"].isoformat(),
+                "value": sample["value"]
+            }), qos=qos("garden_manager/watering"))
+
+
+def handle_watering_request(client, userdata, msg):
+    """Check watering for a soil_humidity sample ingested by another replica."""
+    if not is_leader():
+        return
+    payload = parse_json_payload(msg)
+    payload["timestamp"] = dt.fromisoformat(payload["timestamp"])
+    check_watering(payload)
+
+
+def is_leader():
+    """Return whether this replica makes watering decisions and config writes."""
+    return election is None or election.is_leader
+
+
+def owns_sensor(sensor_id):
+    """Return whether this replica's partition ingests the given sensor."""
+    return int(sensor_id) % replica_count == replica_index
+
+
+def partition_active():
+    """Return whether this replica is the active consumer of its partition."""
+    return partition_lease is None or partition_lease.is_leader
+
+
+def partition_lock_id(index):
+    """Return the advisory lock key of an ingest partition."""
+    return leader_lock_id + 1 + index
+
+
+def data_subscription(sensor_id):
+    """Return the subscription for a sensor's data."""
+    return f"sensors/data/{sensor_id}/#"
+
+
+def partition_topics():
+    """Return the data and batch subscriptions of this replica's partition."""
+    if replica_count == 1:
+        return ["sensors/data/+", "sensors/data/+/+", "sensors/batch/#"]
+    # A batch holds samples from several partitions, so each partition gets a copy.
+    return ["sensors/batch/#"] + [data_subscription(id)
+                                  for id in cache.sensor_ids() if owns_sensor(id)]
+
+
+def handle_partition_lease(is_active):
+    """Consume the partition's data only while holding its lease.
+
+    Replicas started with the same index are standbys: only the holder of
+    the partition's advisory lock subscribes, so each sensor's samples reach
+    a single process in order.
+    """
+    data_qos = qos("sensors/data/#")
+    if is_active:
+        client.subscribe([(topic, data_qos) for topic in partition_topics()])
+    else:
+        client.unsubscribe(partition_topics())
+
+
+def handle_leadership(is_leader):
+    """Take over leader-only duties after winning the election."""
+    if is_leader:
+        # Config handlers share the cache and plant ids, so run on their partition.
+        workers.submit(config_partition, take_leadership)
+
+
+def take_leadership():
+    """Reload the metadata other replicas may have changed and publish it."""
+    if not is_leader():
+        return
+    cache.load()
+    cooldowns.load()
+    publish_config()
+    refresh_status()
+
+
+def publish_config():
+    """Create missing plants and publish the sensor info and plant rules."""
+    reconcile_plants()
+    publish_sensor_info()
+    publish_plant_rules()
+
+
+def refresh_status():
+    """Publish the shared online status from the leader.
+
+    Every replica's last will marks garden_manager offline, so the leader
+    republishes online periodically.
+    """
+    if is_leader():
+        client.publish("status/garden_manager",
+                       payload="online", qos=qos("status/garden_manager"), retain=True)
+
+
+def sample_sensor_id(msg):
+    """Return the sensor_id level of a sample topic."""
+    return msg.topic.split("/")[2]
+
+
+def config_key(msg):
+    """Return the partition key shared by every config message."""
+    return config_partition
+
+
+def dispatch(handler, key=None):
+    """Wrap a message callback so it runs on the worker pool.
+
+    Messages are partitioned by key(msg), or by topic if no key is given,
+    which keeps the messages of each sensor_id in order on a single worker.
+    """
+    def callback(client, userdata, msg):
+        if stopping.is_set():
+            return
+        workers.submit(key(msg) if key else msg.topic,
+                       handler, client, userdata, msg)
+    return callback
+
+
+def maintain_partitions():
+    """Create sample partitions ahead of time from the leader."""
+    if is_leader():
+        ensure_sample_partitions(
+            int(os.environ.get("SAMPLE_PARTITION_MONTHS_AHEAD", 3)))
+
+
+def apply_retention():
+    """Delete expired data from the leader according to the retention policies."""
+    if is_leader():
+        enforce_retention(
+            read_policies(os.environ.get(
+                "RETENTION_POLICY", "retention_policy.yaml")),
+            batch_size=int(os.environ.get("RETENTION_BATCH_SIZE", 5000))
+        )
+
+
+def log_metrics():
+    """Log the counters of the ingest writer, worker pool, connection pool and sequences."""
+    mqtt_logger.info(
+        f"Worker pool: {json.dumps(workers.stats())}")
+    sample_logger.info(
+        f"Ingest writer: {json.dumps(ingest_writer.stats())}")
+    sample_logger.info(
+        f"Connection pool: {json.dumps(pool_stats())}")
+    sample_logger.info(
+        f"Sample sequences: {json.dumps(sequences.stats())}")
 
 
 def publish_status(client, userdata, flags, rc):
     """Publish the status of garden_manager."""
     mqtt_logger.info(connection_message(broker_ip, rc))
     client.publish("status/garden_manager",
-                   payload="online", qos=2, retain=True)
+                   payload="online", qos=qos("status/garden_manager"), retain=True)
     mqtt_logger.info("Published status")
 
 
+def publish_plant_rules():
+    """Publish the compiled watering rule of every plant, retained on plants/rules."""
+    rules = {"enabled": edge_watering, "rules": cache.watering_rules()}
+    client.publish("plants/rules", payload=json.dumps(rules),
+                   qos=qos("plants/rules"), retain=True)
+    mqtt_logger.info(
+        f"Published to plants/rules: {json.dumps(rules, indent=4)}")
+
+
 def publish_sensor_info():
     """Publish the current sensor info."""
     with engine.connect() as conn:
         result = conn.execute(select(sensor_table))
-        info = []
-        for row in result:
-            id, type, name, unit, sample_gap = row
-            info.append({
-                "id": id,
-                "type": type,
-                "name": name,
-                "unit": unit,
-                "sample_gap": sample_gap
-            })
+        info = [dict(row._mapping) for row in result]
     client.publish("sensors/info", payload=json.dumps(info),
-                   qos=2, retain=True)
+                   qos=qos("sensors/info"), retain=True)
     mqtt_logger.info(
         f"Published to sensors/info: {json.dumps(info, indent=4)}")
 
 
 if (__name__ == "__main__"):
     # Add callbacks to the client
-    client.message_callback_add("plants/config", handle_plants_config)
-    client.message_callback_add("sensors/config", handle_sensors_config)
-    client.message_callback_add("sensors/data/+", handle_sensors_data)
-    client.message_callback_add("pumps/control/+", handle_pumps_control)
+    client.message_callback_add(
+        "plants/config", dispatch(handle_plants_config, key=config_key))
+    client.message_callback_add(
+        "sensors/config", dispatch(handle_sensors_config, key=config_key))
+    client.message_callback_add(
+        "sensors/data/#", dispatch(handle_sensors_data, key=sample_sensor_id))
+    client.message_callback_add(
+        "sensors/batch/#", dispatch(handle_sensors_batch))
+    client.message_callback_add(
+        "sensors/status/+", dispatch(handle_sensors_status))
+    client.message_callback_add(
+        "pumps/control/+", dispatch(handle_pumps_control))
+    client.message_callback_add(
+        "pumps/event/+", dispatch(handle_pumps_event))
+    client.message_callback_add(
+        "garden_manager/watering", dispatch(handle_watering_request))
     client.on_connect = publish_status
 
     # Create the last will for garden_manager
     client.will_set("status/garden_manager",
-                    payload="offline", qos=2, retain=True)
+                    payload="offline", qos=qos("status/garden_manager"), retain=True)
 
     # Create connection to MQTT broker
     client.connect("mosquitto", keepalive=5)
 
     # Subscribe to applicable topics
-    client.subscribe([
-        ("plants/config", 2),
-        ("sensors/config", 2),
-        ("sensors/data/+", 2),
-        ("pumps/control/+", 2)
-    ])
-
-    publish_sensor_info()
-
-    client.loop_forever()
+    client.subscribe([(topic, qos(topic)) for topic in [
+        "plants/config",
+        "sensors/config",
+        "sensors/status/+",
+        "pumps/control/+",
+        "pumps/event/+",
+        "garden_manager/watering"
+    ]])
+
+    if replica_count == 1:
+        handle_partition_lease(True)
+        workers.submit(config_partition, publish_config)
+    else:
+        election = leader_election(
+            leader_lock_id,
+            interval=float(os.environ.get("MANAGER_LEASE_INTERVAL", 5)),
+            on_change=handle_leadership
+        )
+        partition_lease = leader_election(
+            partition_lock_id(replica_index),
+            interval=float(os.environ.get("MANAGER_LEASE_INTERVAL", 5)),
+            on_change=handle_partition_lease,
+            name=f"ingest partition {replica_index}"
+        )
+        run_periodically(election.interval, refresh_status)
+
+    run_periodically(
+        float(os.environ.get("METRICS_INTERVAL", 60)), log_metrics)
+
+    # Keep partitions for the coming months in place.
+    maintain_partitions()
+    run_periodically(24 * 3600, maintain_partitions)
+
+    # Delete data that has outlived its retention policy.
+    run_periodically(
+        float(os.environ.get("RETENTION_INTERVAL", 3600)), apply_retention)
+
+    # Shut down on SIGTERM so buffered samples are flushed.
+    signal.signal(signal.SIGTERM, lambda signum, frame: stopping.set())
+
+    client.loop_start()
+    try:
+        # Wake up periodically so KeyboardInterrupt is delivered.
+        while not stopping.wait(1):
+            pass
+    finally:
+        stopping.set()
+        if election:
+            election.stop()
+        if partition_lease:
+            partition_lease.stop()
+        # Finish queued messages, then write out any samples still waiting in the
+        # buffer, while the network loop still sends what they publish.
+        workers.stop()
+        ingest_writer.stop()
+        # A clean disconnect discards the last will, so go offline explicitly.
+        try:
+            client.publish("status/garden_manager", payload="offline",
+                           qos=qos("status/garden_manager"), retain=True).wait_for_publish(5)
+        except (RuntimeError, ValueError) as error:
+            mqtt_logger.warning(f"Failed to publish offline status: {error}")
+        client.disconnect()
+        client.loop_stop()
+        log_metrics()
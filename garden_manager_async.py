@@ -0,0 +1,428 @@
+"""asyncio version of the garden manager.
+
+This module handles logging sensor values to the database as well as the
+automation of watering events, like garden_manager.py, but runs every message
+handler as a coroutine on a single event loop with an async MQTT client and
+an async Postgres driver. It uses the same topics and database schema, but
+runs as a single instance without replicas or leader election.
+
+"""
+import asyncio
+import json
+import os
+import signal
+from datetime import datetime as dt
+
+import paho.mqtt.client as mqtt
+from asyncio_mqtt import Client, Will
+from sqlalchemy import select
+
+from utils.calibration import calibration
+from utils.common import parse_json_payload
+from utils.cooldown_tracker import cooldown_tracker, last_watered_query
+from utils.db_interaction import (build_async_engine, plant_table, pool_stats,
+                                  sensor_table, update_statement,
+                                  upsert_statement, watering_table)
+from utils.logging import config_logger, mqtt_logger, sample_logger
+from utils.metadata_cache import metadata_cache
+from utils.migrations import migrate
+from utils.partitions import ensure_sample_partitions
+from utils.payload_codecs import parse_batch_topic, parse_sample_topic
+from utils.qos_policy import qos
+from utils.retention import enforce_retention, read_policies
+from utils.sample_writer import async_sample_writer
+from utils.sequence_tracker import sequence_tracker
+
+# Host of the MQTT broker
+broker_host = os.environ.get("MQTT_BROKER_HOST", "mosquitto")
+
+# Async engine for the same database as utils.db_interaction.engine
+async_engine = build_async_engine("manager")
+
+# Sensor and plant metadata, kept current from config messages
+cache = metadata_cache()
+
+# Last watering time of every plant, kept current from pump events
+cooldowns = cooldown_tracker()
+
+# Sequence numbers of every sensor's samples, used to drop duplicates and count gaps
+sequences = sequence_tracker()
+
+# Whether garden_monitor makes watering decisions from plants/rules, or the manager does
+edge_watering = os.environ.get("WATERING_MODE", "edge") == "edge"
+
+# Maximum number of messages queued or being handled
+max_in_flight = asyncio.Semaphore(
+    int(os.environ.get("MANAGER_MAX_IN_FLIGHT", 500)))
+
+# Queue and consumer task of every partition key. Like the worker pool of
+# garden_manager.py, messages with the same key are handled one at a time in
+# order, while different keys are handled concurrently.
+message_partitions = {}
+
+
+async def initialize_db():
+    """Migrate the schema and load the metadata cache and cooldown tracker."""
+    # Migrations need DDL outside of transactions, so they use the sync engine.
+    await asyncio.to_thread(migrate)
+    async with async_engine.connect() as conn:
+        sensor_rows = (await conn.execute(select(sensor_table))).fetchall()
+        plant_rows = (await conn.execute(select(plant_table))).fetchall()
+        watering_rows = (await conn.execute(last_watered_query())).fetchall()
+    cache.populate(sensor_rows, plant_rows)
+    cooldowns.populate(watering_rows)
+
+
+async def run_in_thread_periodically(interval, function):
+    """Call a blocking function on a worker thread now and then every interval seconds.
+
+    Exceptions raised by function are logged and do not stop later calls.
+    """
+    while True:
+        try:
+            await asyncio.to_thread(function)
+        except Exception as error:
+            mqtt_logger.exception(
+                f"Periodic call to {function.__name__} failed: {error}")
+        await asyncio.sleep(interval)
+
+
+def maintain_partitions():
+    """Create sample partitions ahead of time."""
+    ensure_sample_partitions(
+        int(os.environ.get("SAMPLE_PARTITION_MONTHS_AHEAD", 3)))
+
+
+def apply_retention():
+    """Delete expired data according to the retention policies."""
+    enforce_retention(
+        read_policies(os.environ.get(
+            "RETENTION_POLICY", "retention_policy.yaml")),
+        batch_size=int(os.environ.get("RETENTION_BATCH_SIZE", 5000))
+    )
+
+
+async def upsert(table, data):
+    """Add or update one or more rows with the same id in a single transaction."""
+    async with async_engine.begin() as conn:
+        await conn.execute(upsert_statement(table, data))
+
+
+async def update(table, id, data):
+    """Update some columns of an existing row."""
+    async with async_engine.begin() as conn:
+        await conn.execute(update_statement(table, id, data))
+
+
+async def reconcile_plants(client):
+    """Create default plants for every soil_humidity sensor without one."""
+    new_plants = cache.missing_plants()
+    if new_plants:
+        await upsert("plant", new_plants)
+        for plant in new_plants:
+            cache.update_plant(plant)
+        mqtt_logger.info(
+            f"Created default plants for sensor_ids {[plant['humidity_sensor_id'] for plant in new_plants]}")
+        await publish_plant_rules(client)
+
+
+async def check_watering(client, msg):
+    """Publish a pump command if the plant for a soil_humidity sample needs water.
+
+    Parameters
+    ----------
+    msg : dict
+        Message from a soil_humidity sensor that may a prompt a watering event.
+            Format:
+                {
+                    sensor_id: <id>,
+                    timestamp: <datetime>,
+                    value: <value>
+                }
+    """
+    if edge_watering:
+        # garden_monitor waters by the plant rules itself.
+        return
+    plant_info = cache.plant_for_sensor(msg["sensor_id"])
+    if plant_info is None:
+        return
+
+    # Check if plant has never been watered or if last time watered is longer than cooldown
+    if cooldowns.ready(plant_info["id"], msg["timestamp"], plant_info["watering_cooldown"]):
+        # Check if the soil humidity is less than target - tolerance
+        if (msg["value"] < plant_info["target"] - plant_info["humidity_tolerance"]):
+            payload = {
+                "duration": plant_info["watering_duration"]
+            }
+            mqtt_logger.info(
+                f"Published to pumps/control/{plant_info['pump_id']}: {json.dumps(payload, indent=4)}")
+            await client.publish(
+                f"pumps/control/{plant_info['pump_id']}", payload=json.dumps(payload),
+                qos=qos("pumps/control/+"))
+
+
+async def handle_pumps_control(client, msg):
+    """Start the plant's cooldown as soon as a pump command is sent.
+
+    The watering event itself is logged from pumps/event once the pump has run.
+    """
+    payload = parse_json_payload(msg)
+    mqtt_logger.info(
+        f"Received pump command for pump_id {msg.topic.split('/')[-1]}: {json.dumps(payload, indent=4)}")
+
+    plant = cache.plant(msg.topic.split("/")[-1])
+    if plant and payload.get("action", "run") != "cancel":
+        cooldowns.record(plant["id"], dt.now())
+
+
+async def handle_pumps_event(client, msg):
+    """Log a watering event in the database when garden_monitor reports a pump run."""
+    payload = parse_json_payload(msg)
+    mqtt_logger.info(
+        f"Received pump event for pump_id {payload['pump_id']}: {json.dumps(payload, indent=4)}")
+
+    plant = cache.plant(payload["pump_id"])
+    if plant is None:
+        return
+    started = dt.fromisoformat(payload["started"])
+    async with async_engine.begin() as conn:
+        await conn.execute(watering_table.insert().values(
+            plant_id=plant["id"], timestamp=started, duration=round(payload["duration"])))
+    cooldowns.record(plant["id"], started)
+
+
+async def handle_plants_config(client, msg):
+    """Update the DB to save plant configs."""
+    payload = parse_json_payload(msg)
+    mqtt_logger.info(f"Received plant config: {json.dumps(payload, indent=4)}")
+    await upsert("plant", payload)
+    cache.update_plant(payload)
+    await publish_plant_rules(client)
+
+
+async def handle_sensors_config(client, msg):
+    """Update the DB with a new sensor config, then broadcast a new 'sensors/info'."""
+    payload = parse_json_payload(msg)
+    mqtt_logger.info(
+        f"Received sensor config: {json.dumps(payload, indent=4)}")
+    payload.update(
+        {
+            "id": int(payload["id"]),
+            "sample_gap": int(payload["sample_gap"])
+        }
+    )
+    # Optional reporting and adaptive sampling settings, None when unset
+    for key, cast in [("deadband", float), ("heartbeat", int), ("min_gap", int),
+                      ("max_gap", int), ("rate_threshold", float)]:
+        if payload.get(key) is not None:
+            payload[key] = cast(payload[key])
+    # An invalid calibration would be republished on the retained sensors/info.
+    if payload.get("calibration") is not None:
+        try:
+            calibration(payload["calibration"])
+        except (ValueError, TypeError) as error:
+            config_logger.error(
+                f"Ignored the calibration of sensor_id {payload['id']}: {error}")
+            payload["calibration"] = None
+    await upsert("sensor", payload)
+    cache.update_sensor(payload)
+    await reconcile_plants(client)
+    await publish_sensor_info(client)
+
+
+async def handle_sensors_data(client, msg):
+    """Buffer received data as a new sample and check whether to water."""
+    sensor_id, codec = parse_sample_topic(msg.topic)
+    payload = codec.decode_sample(msg.payload)
+    if not sequences.check(sensor_id, payload.pop("seq", None)):
+        sample_logger.debug(f"Dropped duplicate sample from sensor_id {sensor_id}")
+        return
+    sample_logger.info(
+        f"Received {payload['value']} from sensor_id {sensor_id}")
+
+    payload["sensor_id"] = sensor_id
+
+    ingest_writer.add(payload)
+
+    sensor = cache.sensor(payload["sensor_id"])
+    if sensor and sensor["type"] == "soil_humidity":
+        await check_watering(client, payload)
+
+
+async def handle_sensors_status(client, msg):
+    """Record the sample gap garden_monitor reports for a sensor on sensors/status/{id}."""
+    sensor_id = int(msg.topic.split("/")[-1])
+    payload = parse_json_payload(msg)
+    if payload.get("status") == "fault":
+        mqtt_logger.warning(
+            f"Sensor {sensor_id} reported a fault: {payload.get('error')}")
+    sensor = cache.sensor(sensor_id)
+    gap = payload.get("sample_gap")
+    if sensor is None or gap is None or sensor.get("effective_gap") == gap:
+        return
+    await update("sensor", sensor_id, {"effective_gap": gap})
+    cache.update_sensor({"id": sensor_id, "effective_gap": gap})
+    mqtt_logger.info(f"Sensor {sensor_id} now samples every {gap} s")
+
+
+async def handle_sensors_batch(client, msg):
+    """Write a batch of samples from several sensors in a single transaction."""
+    samples = [
+        sample for sample in parse_batch_topic(msg.topic).decode_batch(msg.payload)
+        if sequences.check(sample["sensor_id"], sample.pop("seq", None))
+    ]
+    if not samples:
+        return
+    sample_logger.info(f"Received batch of {len(samples)} samples")
+
+    await ingest_writer.write_batch(samples)
+    for sample in samples:
+        sensor = cache.sensor(sample["sensor_id"])
+        if sensor and sensor["type"] == "soil_humidity":
+            await check_watering(client, sample)
+
+
+async def publish_plant_rules(client):
+    """Publish the compiled watering rule of every plant, retained on plants/rules."""
+    rules = {"enabled": edge_watering, "rules": cache.watering_rules()}
+    await client.publish("plants/rules", payload=json.dumps(rules),
+                         qos=qos("plants/rules"), retain=True)
+    mqtt_logger.info(
+        f"Published to plants/rules: {json.dumps(rules, indent=4)}")
+
+
+async def publish_sensor_info(client):
+    """Publish the current sensor info."""
+    async with async_engine.connect() as conn:
+        result = await conn.execute(select(sensor_table))
+        info = [dict(row._mapping) for row in result]
+    await client.publish("sensors/info", payload=json.dumps(info),
+                         qos=qos("sensors/info"), retain=True)
+    mqtt_logger.info(
+        f"Published to sensors/info: {json.dumps(info, indent=4)}")
+
+
+# Handlers for each subscribed topic filter
+handlers = {
+    "plants/config": handle_plants_config,
+    "sensors/config": handle_sensors_config,
+    "sensors/data/+": handle_sensors_data,
+    "sensors/data/+/+": handle_sensors_data,
+    "sensors/batch/#": handle_sensors_batch,
+    "sensors/status/+": handle_sensors_status,
+    "pumps/control/+": handle_pumps_control,
+    "pumps/event/+": handle_pumps_event
+}
+
+
+def partition_key(msg):
+    """Return the key of the partition a message is handled in.
+
+    Samples are partitioned by sensor_id and config messages share one key,
+    so plant reconciliation never runs concurrently. Everything else is
+    partitioned by topic.
+    """
+    if mqtt.topic_matches_sub("sensors/data/#", msg.topic):
+        return msg.topic.split("/")[2]
+    if msg.topic in ["sensors/config", "plants/config"]:
+        return "config"
+    return msg.topic
+
+
+async def consume(client, messages):
+    """Handle the messages of one partition in the order they arrived."""
+    while True:
+        msg = await messages.get()
+        await handle_message(client, msg)
+        messages.task_done()
+
+
+def enqueue(client, msg):
+    """Queue a message on its partition, starting the partition's consumer if needed."""
+    key = partition_key(msg)
+    if key not in message_partitions:
+        messages = asyncio.Queue()
+        message_partitions[key] = (messages, asyncio.create_task(consume(client, messages)))
+    message_partitions[key][0].put_nowait(msg)
+
+
+async def handle_message(client, msg):
+    """Run the handler for a message's topic, logging any failure."""
+    try:
+        for topic_filter, handler in handlers.items():
+            if mqtt.topic_matches_sub(topic_filter, msg.topic):
+                await handler(client, msg)
+    except Exception as error:
+        mqtt_logger.exception(f"Failed to handle message on {msg.topic}: {error}")
+    finally:
+        max_in_flight.release()
+
+
+async def main():
+    """Connect to the broker and handle messages until stopped."""
+    global ingest_writer
+
+    await initialize_db()
+    ingest_writer = async_sample_writer(
+        async_engine,
+        batch_size=int(os.environ.get("INGEST_BATCH_SIZE", 100)),
+        max_latency=float(os.environ.get("INGEST_MAX_LATENCY", 1.0)),
+        max_buffered=int(os.environ.get("INGEST_MAX_BUFFERED", 100000))
+    )
+    ingest_writer.start()
+
+    # Partition maintenance and retention use the sync engine like the migrations, on worker threads.
+    maintenance = [
+        # Keep partitions for the coming months in place.
+        asyncio.create_task(run_in_thread_periodically(24 * 3600, maintain_partitions)),
+        # Delete data that has outlived its retention policy.
+        asyncio.create_task(run_in_thread_periodically(
+            float(os.environ.get("RETENTION_INTERVAL", 3600)), apply_retention))
+    ]
+
+    # Stop handling messages on SIGTERM so buffered samples are flushed on shutdown.
+    stopped = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopped.set)
+
+    will = Will("status/garden_manager", payload="offline",
+                qos=qos("status/garden_manager"), retain=True)
+    async with Client(broker_host, client_id="garden_manager", keepalive=5, will=will) as client:
+        mqtt_logger.info(f"Connected to {broker_host}")
+        await client.publish("status/garden_manager",
+                             payload="online", qos=qos("status/garden_manager"), retain=True)
+        mqtt_logger.info("Published status")
+
+        async with client.unfiltered_messages() as messages:
+            await client.subscribe([(topic_filter, qos(topic_filter)) for topic_filter in handlers])
+            await reconcile_plants(client)
+            await publish_sensor_info(client)
+            await publish_plant_rules(client)
+
+            async def receive():
+                async for msg in messages:
+                    await max_in_flight.acquire()
+                    enqueue(client, msg)
+
+            receiver = asyncio.create_task(receive())
+            await asyncio.wait([receiver, asyncio.create_task(stopped.wait())],
+                               return_when=asyncio.FIRST_COMPLETED)
+            receiver.cancel()
+
+        for task in maintenance:
+            task.cancel()
+        # Finish queued messages, then write out any samples still waiting in the buffer.
+        for messages, consumer in message_partitions.values():
+            await messages.join()
+            consumer.cancel()
+        await ingest_writer.stop()
+        await client.publish("status/garden_manager",
+                             payload="offline", qos=qos("status/garden_manager"), retain=True)
+    sample_logger.info(f"Ingest writer: {json.dumps(ingest_writer.stats())}")
+    sample_logger.info(f"Sample sequences: {json.dumps(sequences.stats())}")
+    sample_logger.info(
+        f"Connection pool: {json.dumps(pool_stats(async_engine.sync_engine))}")
+    await async_engine.dispose()
+
+
+if (__name__ == "__main__"):
+    asyncio.run(main())
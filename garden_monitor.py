@@ -1,7 +1,7 @@
 """Monitor that runs on the pi to collect sensor data and run pumps."""
+import itertools
 import json
 import os
-import threading
 import time
 from datetime import datetime as dt
 
@@ -11,11 +11,20 @@ import yaml
 from gpiozero.output_devices import OutputDevice
 
 from utils.adc_library import ADS7830
+from utils.calibration import calibration
 from utils.common import connection_message, parse_json_payload
+from utils.io_worker import device_fault, io_worker
 from utils.logging import (config_logger, mqtt_logger, pump_logger,
                            sample_logger)
+from utils.payload_codecs import batch_topic, codecs, sample_topic
+from utils.pump_scheduler import pump_scheduler
+from utils.qos_policy import qos
+from utils.sample_spool import sample_spool
+from utils.sampling_scheduler import sampling_scheduler
+from utils.sequence_tracker import first_sequence
 from utils.sensors import (ambient_humidity, ambient_temperature, dht_22,
-                           light, soil_humidity)
+                           light, scan_adc, soil_humidity)
+from utils.watering_rules import watering_rules
 
 # Create the MQTT client
 client = mqtt.Client("garden_monitor")
@@ -29,11 +38,77 @@ sensor_config = {}
 # Sensor dictionary with sensor values that can be sampled
 sensors = {}
 
+# Deadlines of the sensor groups that share a gap
+scheduler = sampling_scheduler()
+
+# Seconds after a watering starts during which its plant's adaptive sensor
+# is read every min_gap, on top of the watering duration
+sample_boost_window = float(os.environ.get("SAMPLE_BOOST_WINDOW", 600))
+
+# Seconds between logging the scheduler and spool counters
+metrics_interval = float(os.environ.get("METRICS_INTERVAL", 60))
+next_metrics = time.monotonic() + metrics_interval
+
+# Codec used to encode sample payloads, json unless SAMPLE_CODEC is set
+sample_codec = codecs[os.environ.get("SAMPLE_CODEC", "json")]
+
+# Publish the readings due in the same pass as one message on sensors/batch
+batch_samples = os.environ.get("SAMPLE_BATCHING", "0") == "1"
+
+# Start of this session's sequence numbers and the counter of every sensor
+session_start = first_sequence()
+sequence_numbers = {}
+
+# Disk-backed spool for samples taken while the broker is unreachable
+spool = sample_spool(
+    os.environ.get("SAMPLE_SPOOL_PATH", "sample_spool.db"),
+    max_rows=int(os.environ.get("SAMPLE_SPOOL_MAX_ROWS", 100000))
+)
+
+# Samples replayed per batch and minimum seconds between replayed batches
+replay_batch_size = int(os.environ.get("SPOOL_REPLAY_BATCH_SIZE", 100))
+replay_interval = float(os.environ.get("SPOOL_REPLAY_INTERVAL", 1.0))
+
+# Seconds before an unacknowledged replay is sent again
+replay_timeout = 30
+
+# Spool row ids, message info and send time of the replayed batch awaiting its ack
+replay_in_flight = None
+
+# Earliest monotonic time of the next replay and of the next reconnect attempt
+next_replay = 0.0
+next_reconnect = 0.0
+
+# Seconds between reconnect attempts while the broker is unreachable
+reconnect_interval = 5.0
+
+# MQTT keepalive in seconds, the network loop never waits longer than half of
+# it so paho sends its PINGREQ before the broker drops the connection
+keepalive = 60
+
 # Make an object to interact with the analog-to-digital converter
 adc = ADS7830()
 
+# Default conversions per ADC reading and the filter that combines them,
+# sensor_config.yaml can set oversample and filter per sensor
+adc_oversample = int(os.environ.get("ADC_OVERSAMPLE", 8))
+adc_filter = os.environ.get("ADC_FILTER", "median")
+
+# Worker thread that reads the ADC with bounded retries and a circuit breaker
+adc_worker = io_worker(
+    "adc",
+    retries=int(os.environ.get("ADC_RETRIES", 2)),
+    timeout=float(os.environ.get("ADC_READ_TIMEOUT", 1.0))
+)
+
+# Current fault of every sensor, None when healthy
+sensor_faults = {}
+
+# Status last published on sensors/status/{id} for every sensor
+sensor_status = {}
+
 # Object used to control access to the dht-22 sensor
-dht_22 = dht_22(board.D17)
+dht_22 = dht_22(board.D17, max_age=float(os.environ.get("DHT_MAX_AGE", 30)))
 
 # Register pumps on GPIO pins
 pump1 = OutputDevice("GPIO26", active_high=False)
@@ -41,9 +116,6 @@ pump2 = OutputDevice("GPIO19", active_high=False)
 pump3 = OutputDevice("GPIO13", active_high=False)
 pump4 = OutputDevice("GPIO6", active_high=False)
 
-# Threading lock to prevent concurrent pump activation
-pump_lock = threading.Lock()
-
 # Map pump ids to their pump objects
 pump_mapping = {
     "1": pump1,
@@ -52,6 +124,17 @@ pump_mapping = {
     "4": pump4
 }
 
+# Plant rules from plants/rules, evaluated after every soil humidity sample
+rules = watering_rules(os.environ.get("WATERING_RULES_PATH", "watering_rules.json"))
+
+# Queue of pump commands, running at most PUMP_MAX_CONCURRENT pumps at once
+pumps = pump_scheduler(
+    pump_mapping,
+    max_concurrent=int(os.environ.get("PUMP_MAX_CONCURRENT", 1)),
+    on_event=lambda event: publish_pump_event(event),
+    on_state=lambda state: publish_pump_status(state)
+)
+
 
 def read_config():
     """Read the config JSON that contains known info about the sensors connected.
@@ -73,7 +156,10 @@ def build_sensors():
             new_sensor = soil_humidity(
                 id, adc, sensor["adc_index"], unit=sensor["unit"],
                 sample_gap=sensor["sample_gap"], dry_value=sensor["dry_value"],
-                wet_value=sensor["wet_value"]
+                wet_value=sensor["wet_value"],
+                oversample=sensor.get("oversample", adc_oversample),
+                filter=sensor.get("filter", adc_filter),
+                calibration=build_calibration(sensor)
             )
             sensors.update({new_sensor.id: new_sensor})
 
@@ -93,67 +179,332 @@ def build_sensors():
             new_sensor = light(
                 id, adc, sensor["adc_index"], unit=sensor["unit"],
                 sample_gap=sensor["sample_gap"], dark_value=sensor["dark_value"],
-                light_value=sensor["light_value"]
+                light_value=sensor["light_value"],
+                oversample=sensor.get("oversample", adc_oversample),
+                filter=sensor.get("filter", adc_filter),
+                calibration=build_calibration(sensor)
             )
             sensors.update({new_sensor.id: new_sensor})
+        sensors[id].set_reporting(sensor.get("deadband"), sensor.get("heartbeat"))
+        sensors[id].set_adaptive(
+            sensor.get("min_gap"), sensor.get("max_gap"), sensor.get("rate_threshold"))
         config_logger.info(
             f"Created {sensor['type']} sensor with id: {sensor['id']}")
+    scheduler.schedule(sensors)
+
+
+def build_calibration(sensor):
+    """Compile the calibration curve of an ADC sensor's config.
+
+    Returns
+    -------
+    utils.calibration.calibration, or None to calibrate with the sensor's two
+    raw values when it has no calibration or an invalid one.
+    """
+    if not sensor.get("calibration"):
+        return None
+    try:
+        return calibration(sensor["calibration"])
+    except (ValueError, TypeError) as error:
+        config_logger.error(
+            f"Ignored the calibration of sensor_id {sensor['id']}: {error}")
+        return None
+
+
+def next_sequence(sensor_id):
+    """Return the next sequence number for a sensor's samples."""
+    if sensor_id not in sequence_numbers:
+        sequence_numbers[sensor_id] = itertools.count(session_start + 1)
+    return next(sequence_numbers[sensor_id])
+
 
+def sample_routine(sensor_ids):
+    """Collect and publish a sample from each of the given sensors.
 
-def activate_pump(pump_id, duration, lock):
-    """Activate pump for a specified amount of time, ensuring that only one pump runs at a time.
+    Soil humidity samples are checked against the watering rules right away,
+    before they are published. Sensors with a deadband only publish readings
+    that moved past it or that are due for a heartbeat. Adaptive sensors are
+    rescheduled when a reading changes their gap.
 
     Parameters
     ----------
-    pump : int
-        ID of the pump to activate.
+    sensor_ids : list
+        IDs of the sensors that the scheduler found due.
+    """
+    batch = []
+    for id, (value, timestamp) in read_sensors(sensor_ids).items():
+        sensor = sensors[id]
+        if isinstance(sensor, soil_humidity):
+            check_watering(id, value, timestamp)
+        previous_gap = sensor.gap
+        if sensor.adapt(value) != previous_gap:
+            scheduler.reschedule(id, sensor.gap)
+            publish_sensor_status(id)
+        if not sensor.should_publish(value):
+            continue
+        payload = {
+            "value": value,
+            "timestamp": timestamp,
+            "seq": next_sequence(id)
+        }
+        if batch_samples:
+            batch.append({"sensor_id": int(id), **payload})
+            continue
+        if not client.is_connected():
+            spool.add({"sensor_id": int(id), **payload})
+            continue
+        topic = sample_topic(id, sample_codec.name)
+        client.publish(topic, payload=sample_codec.encode_sample(payload),
+                       qos=qos(topic))
+        sample_logger.info(
+            f"Published {value}{sensor.unit} for sensor_id {id}")
+
+    if batch and not client.is_connected():
+        for sample in batch:
+            spool.add(sample)
+    elif batch:
+        # One message for every reading due in this pass.
+        topic = batch_topic(sample_codec.name)
+        client.publish(topic, payload=sample_codec.encode_batch(batch),
+                       qos=qos(topic))
+        sample_logger.info(
+            f"Published batch of {len(batch)} samples for sensor_ids {[sample['sensor_id'] for sample in batch]}")
+
+
+def read_sensors(sensor_ids):
+    """Read the given sensors, skipping faulty or stale ones.
+
+    Every due ADC channel is read in a single pass on the ADC's worker thread
+    while the other sensors are read, so a failing ADC cannot stall them.
+
+    Returns
+    -------
+    Dict of (value, timestamp) by sensor_id.
+    """
+    adc_ids = [id for id in sensor_ids
+               if isinstance(sensors[id], (soil_humidity, light))]
+    adc_scan = None
+    adc_error = None
+    if adc_ids:
+        try:
+            adc_scan = adc_worker.submit(scan_adc, [sensors[id] for id in adc_ids])
+        except device_fault as error:
+            adc_error = error
+
+    readings = {}
+    for id in sensor_ids:
+        if id in adc_ids:
+            continue
+        # DHT-22 sensors return their cached reading at once, or None once it is stale.
+        value = sensors[id].sample()
+        report_fault(id, None if value is not None else "No fresh reading")
+        if value is not None:
+            readings[id] = (value, dt.now())
+
+    if adc_scan:
+        try:
+            adc_readings = adc_worker.result(adc_scan)
+            for id in adc_ids:
+                readings[id] = (
+                    sensors[id].convert(adc_readings[sensors[id].adc_index]), dt.now())
+        except device_fault as error:
+            adc_error = error
+    for id in adc_ids:
+        report_fault(id, adc_error)
+    return readings
+
+
+def report_fault(sensor_id, error):
+    """Record whether a sensor's last reading failed and publish its status if it changed.
 
-    duration : int
-        Number of seconds to run the pump.
+    Parameters
+    ----------
+    sensor_id : str
+        ID of the sensor.
 
-    lock : threading.Lock()
-        Lock primitive to prevent pumps running concurrently which may draw too much current.
+    error : Exception or str
+        The fault that prevented the last reading, None if it succeeded.
     """
-    pump = pump_mapping[pump_id]
-    with lock:
-        pump_logger.info(f"Pump {pump_id} activated")
-        pump.on()
-        time.sleep(duration)
-        pump.off()
-        pump_logger.info(f"Pump {pump_id} deactivated")
+    fault = str(error) if error else None
+    if fault and sensor_faults.get(sensor_id) != fault:
+        sample_logger.warning(f"Sensor {sensor_id} is faulty: {fault}")
+    sensor_faults[sensor_id] = fault
+    publish_sensor_status(sensor_id)
+
+
+def publish_sensor_status(sensor_id):
+    """Publish a sensor's health and current gap, retained on sensors/status/{id}, when they change.
+
+    Payload format:
+        {
+            status: <ok or fault>,
+            error: <fault or null>,
+            sample_gap: <seconds until the next reading>,
+            timestamp: <iso datetime>
+        }
+    """
+    fault = sensor_faults.get(sensor_id)
+    status = {
+        "status": "fault" if fault else "ok",
+        "error": fault,
+        "sample_gap": sensors[sensor_id].gap
+    }
+    if sensor_status.get(sensor_id) == status or not client.is_connected():
+        return
+    topic = f"sensors/status/{sensor_id}"
+    client.publish(topic, payload=json.dumps({
+        **status,
+        "timestamp": dt.now().isoformat()
+    }), qos=qos(topic), retain=True)
+    sensor_status[sensor_id] = status
+
+
+def replay_spool():
+    """Publish spooled samples as batches once the broker is reachable again.
+
+    One batch is in flight at a time and batches are at least replay_interval
+    seconds apart, so a long outage does not flood the manager on reconnect.
+    Samples are removed from the spool only after the broker acknowledges them.
+    """
+    global replay_in_flight, next_replay
 
+    if replay_in_flight:
+        ids, info, sent = replay_in_flight
+        if info.is_published():
+            spool.remove(ids)
+            replay_in_flight = None
+            sample_logger.info(
+                f"Replayed {len(ids)} spooled samples, {len(spool)} remaining")
+        elif time.monotonic() - sent > replay_timeout:
+            # Duplicates are dropped by the manager using the sequence numbers.
+            replay_in_flight = None
+        else:
+            return
+
+    if not spool or not client.is_connected() or time.monotonic() < next_replay:
+        return
+    ids, samples = spool.peek(replay_batch_size)
+    topic = batch_topic(sample_codec.name)
+    info = client.publish(topic, payload=sample_codec.encode_batch(samples),
+                          qos=qos(topic))
+    replay_in_flight = (ids, info, time.monotonic())
+    next_replay = time.monotonic() + replay_interval
+
+
+def log_metrics():
+    """Log the scheduler's jitter and CPU counters, the ADC worker, pumps and the spool size."""
+    sample_logger.info(f"Scheduler: {json.dumps(scheduler.stats())}")
+    sample_logger.info(f"ADC worker: {json.dumps(adc_worker.stats())}")
+    pump_logger.info(
+        f"Pumps: {json.dumps({**pumps.state(), 'merged': pumps.merged, 'cancelled': pumps.cancelled})}")
+    sample_logger.info(
+        f"Spool: {json.dumps({'spooled': len(spool), 'dropped': spool.dropped})}")
+
+
+def loop_timeout():
+    """Return the seconds the network loop may wait before the next thing is due."""
+    now = time.monotonic()
+    deadlines = [next_metrics - now, keepalive / 2]
+    until_sample = scheduler.time_until_next()
+    if until_sample is not None:
+        deadlines.append(until_sample)
+    if spool and client.is_connected():
+        deadlines.append(next_replay - now)
+    return max(min(deadlines), 0.0)
+
+
+def reconnect():
+    """Try to reconnect to the broker, at most once every reconnect_interval seconds."""
+    global next_reconnect
+
+    if time.monotonic() < next_reconnect:
+        return
+    next_reconnect = time.monotonic() + reconnect_interval
+    try:
+        client.reconnect()
+    except OSError as error:
+        mqtt_logger.warning(
+            f"Broker unreachable, {len(spool)} samples spooled: {error}")
+
+
+def check_watering(sensor_id, value, timestamp):
+    """Queue the plant's pump if a soil humidity sample breaks its watering rule."""
+    rule = rules.evaluate(sensor_id, value, timestamp)
+    if rule is None:
+        return
+    pump_logger.info(
+        f"Sensor {sensor_id} read {value}, watering plant {rule['plant_id']} for {rule['duration']} s")
+    try:
+        pumps.submit(rule["pump_id"], rule["duration"])
+    except ValueError as error:
+        pump_logger.error(f"Cannot water plant {rule['plant_id']}: {error}")
+        return
+    rules.record(rule["plant_id"], timestamp)
+    boost_sampling(rule["pump_id"], rule["duration"])
+
+
+def boost_sampling(pump_id, duration):
+    """Read the soil humidity sensor of the plant a pump waters every min_gap while it soaks in."""
+    sensor_id = rules.sensor_for_pump(pump_id)
+    if sensor_id not in sensors:
+        return
+    sensor = sensors[sensor_id]
+    previous_gap = sensor.gap
+    if sensor.boost(duration + sample_boost_window) != previous_gap:
+        scheduler.reschedule(sensor_id, sensor.gap)
+        publish_sensor_status(sensor_id)
+
+
+def handle_plant_rules(client, userdata, msg):
+    """Replace the watering rules with the ones garden_manager compiled."""
+    payload = parse_json_payload(msg)
+    rules.update(payload)
+    config_logger.info(
+        f"Received plant rules: {json.dumps(payload, indent=4)}")
 
-def sample_routine():
-    """Run the main routines of the program.
 
-    Collects data from the sensors if their sample_gap has elapsed since the last collection
-    event. Then checks for MQTT messages.
-    """
-    for id, sensor in sensors.items():
-        if (dt.now() - sensor.last_sample).total_seconds() > (sensor.sample_gap):
-            value = sensor.sample()
-            timestamp = dt.now()
-            payload = {
-                "value": value,
-                "timestamp": timestamp.isoformat()
-            }
-            client.publish(f'sensors/data/{id}',
-                           payload=json.dumps(payload), qos=2)
-            sample_logger.info(
-                f"Published {value}{sensor.unit} for sensor_id {id}")
+def publish_pump_event(event):
+    """Publish when a pump actually ran on pumps/event/{id}."""
+    # Runs ordered by garden_manager or by hand also restart the plant's cooldown.
+    rule = rules.rule_for_pump(event["pump_id"])
+    if rule:
+        rules.record(rule["plant_id"], event["started"])
+    topic = f"pumps/event/{event['pump_id']}"
+    client.publish(topic, payload=json.dumps({
+        **event,
+        "started": event["started"].isoformat(),
+        "stopped": event["stopped"].isoformat()
+    }), qos=qos(topic))
+
+
+def publish_pump_status(state):
+    """Publish the running and queued pumps, retained on pumps/status."""
+    client.publish("pumps/status", payload=json.dumps(state),
+                   qos=qos("pumps/status"), retain=True)
 
 
 def handle_pumps_control(client, userdata, msg):
-    """Activate a specified pump when a message is received on pumps/control/{id}."""
+    """Queue, replace or cancel a pump command received on pumps/control/{id}.
+
+    Payload format:
+        {
+            duration: <seconds>,
+            action: <run (default), replace or cancel>
+        }
+    """
     data = parse_json_payload(msg)
     mqtt_logger.info(
         f"Pump instruction received: {json.dumps(data, indent=4)}")
 
     pump_id = msg.topic.split("/")[-1]
 
-    new_thread = threading.Thread(target=activate_pump, args=(
-        pump_id, data["duration"], pump_lock))
-    new_thread.start()
+    try:
+        pumps.submit(pump_id, data.get("duration", 0), data.get("action", "run"))
+    except ValueError as error:
+        mqtt_logger.error(f"Ignored pump instruction: {error}")
+        return
+    if data.get("action", "run") != "cancel":
+        boost_sampling(pump_id, data.get("duration", 0))
 
 
 def handle_sensor_info(client, userdata, msg):
@@ -175,6 +526,12 @@ def handle_sensor_info(client, userdata, msg):
                     "sample_gap": known_sensor["sample_gap"]
                 }
             )
+            # Reporting, adaptive sampling and calibration settings are only
+            # overridden once set in the database.
+            for key in ["deadband", "heartbeat", "min_gap", "max_gap", "rate_threshold",
+                        "calibration"]:
+                if known_sensor.get(key) is not None:
+                    sensor_config[str(known_sensor["id"])][key] = known_sensor[key]
     # For sensors that sensors/info didn't know about, we send a default config to sensors/config
     known_ids = [str(sensor["id"]) for sensor in known_sensors]
     for id, sensor in sensor_config.items():
@@ -184,12 +541,18 @@ def handle_sensor_info(client, userdata, msg):
                 "type": sensor["type"],
                 "name": sensor["name"],
                 "unit": sensor["unit"],
-                "sample_gap": sensor["sample_gap"]
+                "sample_gap": sensor["sample_gap"],
+                "deadband": sensor.get("deadband"),
+                "heartbeat": sensor.get("heartbeat"),
+                "min_gap": sensor.get("min_gap"),
+                "max_gap": sensor.get("max_gap"),
+                "rate_threshold": sensor.get("rate_threshold"),
+                "calibration": sensor.get("calibration")
             }
             mqtt_logger.info(
                 f"Publishing new sensor config for sensor_id {id}")
             client.publish("sensors/config",
-                           payload=json.dumps(payload), qos=2, retain=False)
+                           payload=json.dumps(payload), qos=qos("sensors/config"), retain=False)
 
     # Once config has been reconciled, build sensors.
     build_sensors()
@@ -199,10 +562,25 @@ def publish_status(client, userdata=None, flags=None, rc=None):
     """Publish the status of garden_monitor."""
     mqtt_logger.info(connection_message(broker_host, rc))
     client.publish("status/garden_monitor",
-                   payload="online", qos=2, retain=True)
+                   payload="online", qos=qos("status/garden_monitor"), retain=True)
     mqtt_logger.info("Status published")
 
 
+def handle_connect(client, userdata, flags, rc):
+    """Publish the online status and subscribe again after every (re)connect."""
+    publish_status(client, userdata, flags, rc)
+    client.subscribe([
+        ("sensors/info", qos("sensors/info")),
+        ("plants/rules", qos("plants/rules")),
+        ("pumps/control/+", qos("pumps/control/+"))
+    ])
+
+
+def handle_disconnect(client, userdata, rc):
+    """Log a lost connection, samples are spooled until it is back."""
+    mqtt_logger.warning(f"Disconnected from {broker_host} with return code {rc}")
+
+
 """
 On startup, sensor info is empty
 garden monitor will call sensor config for each of the sensors not in sensor info
@@ -214,31 +592,35 @@ included.
 if __name__ == '__main__':
     # Set garden_monitor's last will message for when it is offline.
     client.will_set("status/garden_monitor",
-                    payload="offline", qos=2, retain=True)
+                    payload="offline", qos=qos("status/garden_monitor"), retain=True)
 
     # Set callback methods
-    client.on_connect = publish_status
+    client.on_connect = handle_connect
+    client.on_disconnect = handle_disconnect
     client.message_callback_add("pumps/control/#", handle_pumps_control)
     client.message_callback_add("sensors/info", handle_sensor_info)
+    client.message_callback_add("plants/rules", handle_plant_rules)
 
-    # Connect to the MQTT broker
-    client.connect(os.environ.get("MQTT_BROKER_HOST"), 1883)
-
-    # Subscribe to applicable topics
-    client.subscribe([
-        ("sensors/info", 2),
-        ("pumps/control/+", 2)
-    ])
-
-    # Send online message
-    publish_status(client)
+    # Connect to the MQTT broker, the main loop keeps retrying if it is unreachable.
+    # handle_connect subscribes to the applicable topics and sends the online message.
+    try:
+        client.connect(os.environ.get("MQTT_BROKER_HOST"), 1883, keepalive=keepalive)
+    except OSError as error:
+        mqtt_logger.warning(f"Broker unreachable, spooling samples: {error}")
 
     # Load basic values in.
     sensor_config = read_config()
 
     build_sensors()
 
-    # Start the main routine
+    # Sample whatever is due, then wait on the network until the next deadline.
     while(True):
-        sample_routine()
-        client.loop()
+        sample_routine(scheduler.due())
+        replay_spool()
+        if time.monotonic() >= next_metrics:
+            log_metrics()
+            next_metrics += metrics_interval
+        if client.loop(timeout=loop_timeout()) != mqtt.MQTT_ERR_SUCCESS:
+            reconnect()
+            # Without a socket the network loop returns at once.
+            time.sleep(loop_timeout())
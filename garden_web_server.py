@@ -1,4 +1,7 @@
 """Entry point for the garden web server."""
+import json
+import os
+
 from pages import configuration, controls, history, overview
 import dash
 import dash_bootstrap_components as dbc
@@ -7,6 +10,10 @@ import dash_html_components as html
 import paho.mqtt.client as mqtt
 from dash.dependencies import Input, Output
 from app import app
+from utils.common import run_periodically
+from utils.db_interaction import pool_stats
+from utils.logging import config_logger
+from utils.qos_policy import qos
 
 # MQTT client
 client = mqtt.Client("garden_web_server")
@@ -106,6 +113,12 @@ if __name__ == '__main__':
     client.connect("mosquitto")
     client.loop_start()
     client.message_callback_add("status/+", mqtt_record_status)
-    client.subscribe("status/+", qos=2)
+    client.subscribe("status/+", qos=qos("status/+"))
+
+    # Log how busy the connection pool shared by the Dash callbacks is.
+    run_periodically(
+        float(os.environ.get("METRICS_INTERVAL", 60)),
+        lambda: config_logger.info(f"Connection pool: {json.dumps(pool_stats())}"),
+        name="log_pool_stats")
 
     app.run_server(port=8050, host="0.0.0.0")
@@ -12,6 +12,7 @@ from dash.dependencies import Input, Output, State
 from sqlalchemy import select
 from utils.db_interaction import engine, plant_table, sensor_table
 from utils.logging import mqtt_logger
+from utils.qos_policy import qos
 
 pump_list = [
     (1, "pump_1"),
@@ -168,6 +169,10 @@ layout = [
                                     className="col-md-3"
                                 )
                             ], className="py-2"),
+                            dbc.InputGroup([
+                                html.H5("Effective Rate", className="col-md-3"),
+                                html.H5(id="effective_rate", className="px-2")
+                            ], className="py-2"),
                             html.Div([
                                 dbc.Button(
                                     "Cancel", id="cancel_sensors", n_clicks=0),
@@ -239,7 +244,7 @@ def savePlants(n_clicks, selectedPlant, name, humidity_sensor_id, pump_id, targe
             "humidity_tolerance": humidity_tolerance
         }
         publish.single(f"plants/config",
-                       payload=json.dumps(payload), qos=2,
+                       payload=json.dumps(payload), qos=qos("plants/config"),
                        hostname=sys.argv[1])
 
         mqtt_logger.info(
@@ -257,6 +262,7 @@ def savePlants(n_clicks, selectedPlant, name, humidity_sensor_id, pump_id, targe
     Output("sensor_label", "value"),
     Output("samples", "value"),
     Output("rate", "value"),
+    Output("effective_rate", "children"),
     Input("selectedSensor", "value"),
     Input("cancel_sensors", "n_clicks")
 )
@@ -266,16 +272,31 @@ def load_sensor_config(selected_sensor, n_clicks):
     if caller == "selectedSensor.value" and selected_sensor:
         with engine.connect() as conn:
             result = conn.execute(
-                select(sensor_table)
+                select(sensor_table.c.name, sensor_table.c.sample_gap,
+                       sensor_table.c.min_gap, sensor_table.c.max_gap,
+                       sensor_table.c.effective_gap)
                 .where(sensor_table.c.id == selected_sensor)
             ).fetchone()
-        id, type, name, unit, sample_gap = result
+        name, sample_gap, min_gap, max_gap, effective_gap = result
+
+        effective_rate = describe_gap(effective_gap or sample_gap)
+        if min_gap is not None and max_gap is not None:
+            effective_rate += f" (adaptive, every {min_gap} to {max_gap} seconds)"
 
         for unit, unit_length in rate_mapping.items():
             unit_amount = unit_length / sample_gap
             if unit_amount.is_integer():
-                return name, unit_amount, unit
-    return None, "",  0
+                return name, unit_amount, unit, effective_rate
+    return None, "",  0, ""
+
+
+def describe_gap(gap):
+    """Describe a sample gap in seconds as a number of samples per time unit."""
+    for unit, unit_length in rate_mapping.items():
+        if unit_length / gap >= 1:
+            count = round(unit_length / gap, 1)
+            return f"{count:g} {'sample' if count == 1 else 'samples'} per {unit}"
+    return f"1 sample per {gap} seconds"
 
 
 @ app.callback(
@@ -307,7 +328,8 @@ def saveSensors(n_clicks, sensor_id, name, unit_amount, time_unit):
                 "sample_gap": int(sample_gap)
             }
             publish.single(f"sensors/config",
-                           payload=json.dumps(payload), qos=2, hostname=sys.argv[1])
+                           payload=json.dumps(payload), qos=qos("sensors/config"),
+                           hostname=sys.argv[1])
 
             mqtt_logger.info(
                 f"Published to /sensors/config: {json.dumps(payload, indent=4)}")
@@ -8,6 +8,7 @@ import dash_html_components as html
 import paho.mqtt.publish as publish
 from app import app
 from dash.dependencies import Input, Output, State
+from utils.qos_policy import qos
 
 pumps = ["pump1", "pump2", "pump3", "pump4"]
 
@@ -69,21 +70,21 @@ def perform_pump(n_clicks, pump1, pump2, pump3, pump4):
             publish.single(
                 "pumps/control/1",
                 payload=json.dumps({"duration": pump1}),
-                qos=2, hostname=sys.argv[1])
+                qos=qos("pumps/control/+"), hostname=sys.argv[1])
         if pump2:
             publish.single(
                 "pumps/control/2",
                 payload=json.dumps({"duration": pump2}),
-                qos=2, hostname=sys.argv[1])
+                qos=qos("pumps/control/+"), hostname=sys.argv[1])
         if pump3:
             publish.single(
                 "pumps/control/3",
                 payload=json.dumps({"duration": pump3}),
-                qos=2, hostname=sys.argv[1])
+                qos=qos("pumps/control/+"), hostname=sys.argv[1])
         if pump4:
             publish.single(
                 "pumps/control/4",
                 payload=json.dumps({"duration": pump4}),
-                qos=2, hostname=sys.argv[1])
+                qos=qos("pumps/control/+"), hostname=sys.argv[1])
         return "Performing manual pump.."
     return dash.no_update
@@ -9,11 +9,15 @@ import plotly.graph_objects as go
 from app import app
 from dash.dependencies import Input, Output
 from sqlalchemy import between, select
-from utils.db_interaction import (engine, plant_table, sample_table,
+from utils.db_interaction import (engine, plant_table, sample_rollup_table,
                                   sensor_table, watering_table)
+from utils.rollups import choose_resolution, sample_source
 
 history_graph = go.Figure()
 
+# Approximate width of the history graph in pixels, used to pick how coarse the data can be.
+graph_width = 1200
+
 # Earliest datetime to pull data from.
 data_start = dt.datetime.now() - dt.timedelta(hours=4)
 
@@ -144,27 +148,61 @@ def set_start_date():
     return False
 
 
+def read_samples(query_columns, resolution):
+    """Build a select of samples at the given resolution within the current window.
+
+    Parameters
+    ----------
+    query_columns : list
+        Extra columns to select after the timestamp and value.
+
+    resolution : str
+        Name of a rollup resolution or None for raw samples.
+    """
+    table, timestamp, value = sample_source(resolution)
+    query = (
+        select(timestamp, value, *query_columns)
+        .join_from(table, sensor_table)
+        .order_by(timestamp.desc())
+        .where(between(timestamp, data_start, dt.datetime.now()))
+    )
+    if resolution is not None:
+        query = query.where(sample_rollup_table.c.resolution == resolution)
+    return query
+
+
+def line_shape(deadband):
+    """Return the line shape of a sensor's trace.
+
+    Sensors with a deadband only publish changes, so their value holds until
+    the next sample and is drawn as steps. Samples are ordered newest first,
+    so "vh" holds each older value up to the next newer sample.
+    """
+    return "vh" if deadband else "linear"
+
+
 def get_plant_traces(plant_ids, fields):
     """Generate the traces for plant specific sensors."""
+    # Use the coarsest data that still has a point for every pixel.
+    resolution = choose_resolution(data_start, dt.datetime.now(), graph_width)
+
     # Get plant data
     traces = []
     with engine.connect() as conn:
         for plant_id in plant_ids:
             result = conn.execute(
-                select(sample_table.c.timestamp, sensor_table.c.name,
-                       sample_table.c.value, sensor_table.c.unit, plant_table.c.target)
-                .join_from(sample_table, sensor_table)
+                read_samples([sensor_table.c.name, sensor_table.c.unit,
+                              sensor_table.c.deadband, plant_table.c.target], resolution)
                 .join_from(sensor_table, plant_table)
-                .order_by(sample_table.c.timestamp.desc())
-                .where(between(sample_table.c.timestamp, data_start, dt.datetime.now()))
                 .where(plant_table.c.id == plant_id)
             ).fetchall()
             data = pd.DataFrame(
-                result, columns=["timestamp", "sensor_name", "value", "unit", "target"])
+                result, columns=["timestamp", "value", "sensor_name", "unit", "deadband", "target"])
             if "soil_humidity" in fields:
                 traces.append(go.Scatter(
                     x=data["timestamp"],
                     y=data["value"],
+                    line_shape=line_shape(data["deadband"][0]),
                     name=data["sensor_name"][0] + " Soil Humidity"))
 
             if "humidity_target" in fields:
@@ -196,22 +234,23 @@ def add_watering_events(plant_ids, figure):
 
 def get_ambient_traces(selected_sensors):
     """Generate the traces for ambient sensors."""
+    # Use the coarsest data that still has a point for every pixel.
+    resolution = choose_resolution(data_start, dt.datetime.now(), graph_width)
+
     # Get ambient data
     traces = []
     with engine.connect() as conn:
         for sensor_id in selected_sensors:
             result = conn.execute(
-                select(sample_table.c.timestamp, sensor_table.c.name,
-                       sample_table.c.value, sensor_table.c.unit)
-                .join_from(sample_table, sensor_table)
-                .order_by(sample_table.c.timestamp.desc())
-                .where(between(sample_table.c.timestamp, data_start, dt.datetime.now()))
+                read_samples([sensor_table.c.name, sensor_table.c.unit,
+                              sensor_table.c.deadband], resolution)
                 .where(sensor_table.c.id == sensor_id)
             ).fetchall()
             data = pd.DataFrame(
-                result, columns=["timestamp", "sensor_name", "value", "unit"])
+                result, columns=["timestamp", "value", "sensor_name", "unit", "deadband"])
             traces.append(go.Scatter(
-                x=data["timestamp"], y=data["value"], name=data["sensor_name"][0]))
+                x=data["timestamp"], y=data["value"],
+                line_shape=line_shape(data["deadband"][0]), name=data["sensor_name"][0]))
     return traces
 
 
@@ -6,11 +6,26 @@
 # modification: 2020/04/21
 ########################################################################
 
-import time
+import statistics
 
 import smbus
 
 
+def trimmed_mean(values, proportion=0.25):
+    """Mean of values after dropping proportion of the readings at each end."""
+    values = sorted(values)
+    cut = int(len(values) * proportion)
+    return statistics.fmean(values[cut:len(values) - cut] or values)
+
+
+# Filters that reduce the oversampled readings of a channel to one value
+filters = {
+    "median": statistics.median,
+    "trimmed_mean": trimmed_mean,
+    "mean": statistics.fmean
+}
+
+
 class ADCDevice(object):
     def __init__(self):
         self.cmd = 0
@@ -38,11 +53,34 @@ class ADS7830(ADCDevice):
         # 0x4b is the default i2c address for ADS7830 Module.
         self.address = 0x4b
 
+    def channelCommand(self, chn):
+        """Return the command byte that selects single-ended channel chn."""
+        return self.cmd | (((chn << 2 | chn >> 1) & 0x07) << 4)
+
     def analogRead(self, chn):  # ADS7830 has 8 ADC input pins, chn:0,1,2,3,4,5,6,7
-        try:
-            value = self.bus.read_byte_data(
-                self.address, self.cmd | (((chn << 2 | chn >> 1) & 0x07) << 4))
-        except:
-            time.sleep(.5)
-            return self.analogRead(chn)
-        return value
+        # Errors are raised to the caller, utils.io_worker retries them with a bound.
+        return self.bus.read_byte_data(self.address, self.channelCommand(chn))
+
+    def scan(self, channels):
+        """Read several channels in one pass with oversampling and filtering.
+
+        Every channel is read with a single block read, in which each byte is a
+        new conversion of that channel.
+
+        Parameters
+        ----------
+        channels : dict
+            (oversample, filter name) by channel. oversample is the number of
+            conversions per channel, at most 32, and the filter is a key of
+            filters that reduces them to one value.
+
+        Returns
+        -------
+        Dict of the filtered reading of each channel.
+        """
+        readings = {}
+        for chn, (oversample, filter) in channels.items():
+            values = self.bus.read_i2c_block_data(
+                self.address, self.channelCommand(chn), max(1, min(oversample, 32)))
+            readings[chn] = filters[filter](values)
+        return readings
@@ -0,0 +1,101 @@
+"""Calibration curves of sensors read through the 8-bit ADS7830 ADC.
+
+A curve maps raw ADC codes to the sensor's unit. Every curve is compiled once
+into a table with an entry per code. Oversampled and filtered readings fall
+between codes, so a reading is converted by interpolating between the two
+entries around it, and a batch of readings converts with one numpy call.
+
+Calibration config format, in sensor_config.yaml or on sensors/config:
+    {
+        curve: <piecewise_linear or polynomial>,
+        points: [[<raw>, <value>], ...],   # piecewise_linear, at least two
+        coefficients: [<c0>, <c1>, ...],   # polynomial, lowest power first
+        min: <smallest value, default 0>,
+        max: <largest value, default 100>
+    }
+"""
+import numpy as np
+
+# Number of codes of the 8-bit ADS7830, one table entry each
+adc_codes = 256
+
+# Decimals kept in converted values
+decimals = 2
+
+
+def piecewise_linear(config):
+    """Return the value of every ADC code interpolated between calibration points.
+
+    Codes outside the points take the value of the nearest point.
+    """
+    points = sorted(config.get("points") or [])
+    if len(points) < 2 or len({raw for raw, value in points}) < len(points):
+        raise ValueError(
+            "A piecewise_linear calibration needs at least two points with distinct raw values")
+    raw, values = zip(*points)
+    return np.interp(np.arange(adc_codes), raw, values)
+
+
+def polynomial(config):
+    """Return the value of every ADC code on a polynomial of the code."""
+    coefficients = config.get("coefficients")
+    if not coefficients:
+        raise ValueError("A polynomial calibration needs coefficients")
+    return np.polynomial.polynomial.polyval(np.arange(adc_codes), coefficients)
+
+
+# Functions computing the value of every ADC code for each curve type
+curves = {
+    "piecewise_linear": piecewise_linear,
+    "polynomial": polynomial
+}
+
+
+class calibration():
+    """A calibration curve compiled to a lookup table of every ADC code."""
+
+    def __init__(self, config):
+        """Compile a calibration config.
+
+        Raises
+        ------
+        ValueError if the config is not a dict, or the curve type is unknown or
+        its parameters are invalid.
+        """
+        if not isinstance(config, dict):
+            raise ValueError(
+                f"A calibration must be a mapping, not {type(config).__name__}")
+        curve = config.get("curve", "piecewise_linear")
+        if curve not in curves:
+            raise ValueError(
+                f"Unknown calibration curve {curve}, expected one of {list(curves)}")
+        self.config = config
+        self.table = np.clip(
+            curves[curve](config), config.get("min", 0), config.get("max", 100))
+        # Plain floats, indexing a list is faster than a numpy array for one reading.
+        self.values = self.table.tolist()
+        # Largest change between neighbouring codes, the resolution of a reading.
+        self.step = float(np.max(np.abs(np.diff(self.table))))
+
+    def convert(self, raw_reading):
+        """Convert one filtered ADC reading, interpolating between the codes around it."""
+        raw_reading = min(max(raw_reading, 0), adc_codes - 1)
+        code = min(int(raw_reading), adc_codes - 2)
+        low = self.values[code]
+        return round(low + (self.values[code + 1] - low) * (raw_reading - code), decimals)
+
+    def convert_batch(self, raw_readings):
+        """Convert a sequence of filtered ADC readings at once.
+
+        Returns
+        -------
+        numpy array of the converted values.
+        """
+        return np.round(np.interp(
+            np.asarray(raw_readings, dtype=float), np.arange(adc_codes), self.table), decimals)
+
+
+def two_point(first_raw, first_value, second_raw, second_value):
+    """Return the calibration of a straight line through two points."""
+    return calibration({"curve": "piecewise_linear",
+                        "points": [[first_raw, first_value], [second_raw, second_value]]})
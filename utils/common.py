@@ -1,5 +1,7 @@
 """Common methods for reuse."""
 import json
+import logging
+import threading
 
 
 def connection_message(broker_ip, rc):
@@ -10,3 +12,27 @@ def connection_message(broker_ip, rc):
 def parse_json_payload(msg):
     """Parse raw MQTT payload into a Python primitives."""
     return json.loads(msg.payload.decode())
+
+
+def run_periodically(interval, function, name=None):
+    """Call function every interval seconds on a daemon thread.
+
+    Exceptions raised by function are logged and do not stop later calls.
+
+    Returns
+    -------
+    threading.Event that stops the thread when set.
+    """
+    stopped = threading.Event()
+
+    def run():
+        while not stopped.wait(interval):
+            try:
+                function()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    f"Periodic call to {function.__name__} failed")
+
+    threading.Thread(target=run, name=name or function.__name__,
+                     daemon=True).start()
+    return stopped
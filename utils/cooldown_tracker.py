@@ -0,0 +1,60 @@
+"""In-memory record of when each plant was last watered."""
+import threading
+
+from sqlalchemy import func, select
+
+from utils.db_interaction import engine, watering_table
+
+
+def last_watered_query():
+    """Select the latest watering event timestamp of every plant."""
+    return (
+        select(watering_table.c.plant_id,
+               func.max(watering_table.c.timestamp))
+        .group_by(watering_table.c.plant_id)
+    )
+
+
+class cooldown_tracker():
+    """Track the last watering time per plant so cooldowns need no DB access."""
+
+    def __init__(self):
+        """Create an empty tracker."""
+        self._lock = threading.Lock()
+        self.last_watered = {}
+
+    def load(self):
+        """Seed the tracker with the latest watering event of every plant."""
+        with engine.connect() as conn:
+            result = conn.execute(last_watered_query()).fetchall()
+        self.populate(result)
+
+    def populate(self, rows):
+        """Replace the tracker contents with (plant_id, timestamp) rows."""
+        with self._lock:
+            self.last_watered = {
+                plant_id: timestamp for plant_id, timestamp in rows}
+
+    def record(self, plant_id, timestamp):
+        """Record a watering event, ignoring events older than the latest known one."""
+        with self._lock:
+            last = self.last_watered.get(plant_id)
+            if last is None or timestamp > last:
+                self.last_watered[plant_id] = timestamp
+
+    def ready(self, plant_id, timestamp, cooldown):
+        """Return whether more than cooldown seconds have passed since the last watering.
+
+        Parameters
+        ----------
+        plant_id : int
+            ID of the plant to check.
+
+        timestamp : datetime
+            The time to check against, usually the timestamp of a sample.
+
+        cooldown : int
+            Minimum number of seconds between watering events.
+        """
+        last = self.last_watered.get(plant_id)
+        return last is None or (timestamp - last).total_seconds() > cooldown
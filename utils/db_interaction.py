@@ -1,12 +1,160 @@
 """Utility functions for interacting with the database."""
+import os
+import threading
+import time
 
-from sqlalchemy import (TIMESTAMP, Column, ForeignKey, Integer, MetaData,
-                        String, Table, create_engine)
+from sqlalchemy import (JSON, TIMESTAMP, Column, Float, ForeignKey, Integer,
+                        MetaData, String, Table, create_engine, exc, update)
 from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+# Default URL of the garden database
+default_db_url = "postgresql://postgres:password@db:5432/garden_db"
+
+# Engine settings for each program that connects to the database. Every
+# setting can be overridden with a GARDEN_DB_<SETTING> environment variable.
+engine_profiles = {
+    # Long running ingest and automation, few concurrent connections
+    "manager": {
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_timeout": 30000
+    },
+    # One connection per concurrent Dash callback, queries should fail fast
+    "web_server": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_timeout": 10000
+    }
+}
+
+
+class _pool_instrumentation():
+    """Mixin that records how long connection checkouts wait on the pool."""
+
+    def __init__(self, *args, **kwargs):
+        """Create the pool with zeroed counters."""
+        super().__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.checkouts = 0
+        self.checkout_timeouts = 0
+        self.total_wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    def _do_get(self):
+        """Check out a connection, timing the wait."""
+        start = time.monotonic()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.checkout_timeouts += 1
+            raise
+        finally:
+            wait = time.monotonic() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.total_wait_seconds += wait
+                self.max_wait_seconds = max(self.max_wait_seconds, wait)
+
+
+class instrumented_queue_pool(_pool_instrumentation, QueuePool):
+    """QueuePool that records checkout wait times."""
+
+
+class instrumented_async_queue_pool(_pool_instrumentation, AsyncAdaptedQueuePool):
+    """AsyncAdaptedQueuePool that records checkout wait times."""
+
+
+def engine_settings(profile):
+    """Return the settings of an engine profile with environment overrides applied.
+
+    Parameters
+    ----------
+    profile : str
+        Name of a profile in engine_profiles.
+    """
+    settings = {"url": default_db_url, **engine_profiles[profile]}
+    for name, value in settings.items():
+        override = os.environ.get(f"GARDEN_DB_{name.upper()}")
+        if override is None:
+            continue
+        if isinstance(value, bool):
+            settings[name] = override.lower() in ["1", "true", "yes"]
+        else:
+            settings[name] = type(value)(override)
+    return settings
+
+
+def build_engine(profile):
+    """Create an instrumented engine for the given profile."""
+    settings = engine_settings(profile)
+    return create_engine(
+        settings["url"],
+        future=True,
+        poolclass=instrumented_queue_pool,
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_timeout=settings["pool_timeout"],
+        pool_recycle=settings["pool_recycle"],
+        pool_pre_ping=settings["pool_pre_ping"],
+        connect_args={
+            "options": f"-c statement_timeout={settings['statement_timeout']}"}
+    )
+
+
+def build_async_engine(profile):
+    """Create an instrumented asyncpg engine for the given profile."""
+    # Only the asyncio manager needs the asyncio extension.
+    from sqlalchemy.engine import make_url
+    from sqlalchemy.ext.asyncio import create_async_engine
+
+    settings = engine_settings(profile)
+    return create_async_engine(
+        make_url(settings["url"]).set(drivername="postgresql+asyncpg"),
+        future=True,
+        poolclass=instrumented_async_queue_pool,
+        pool_size=settings["pool_size"],
+        max_overflow=settings["max_overflow"],
+        pool_timeout=settings["pool_timeout"],
+        pool_recycle=settings["pool_recycle"],
+        pool_pre_ping=settings["pool_pre_ping"],
+        connect_args={
+            "server_settings": {"statement_timeout": str(settings["statement_timeout"])}}
+    )
+
+
+def pool_stats(pool_engine=None):
+    """Return the usage and checkout wait counters of an engine's pool.
+
+    Parameters
+    ----------
+    pool_engine : sqlalchemy.engine.Engine
+        Engine to inspect, the shared engine if not given. Async engines
+        should pass their sync_engine.
+    """
+    pool = (pool_engine or engine).pool
+    capacity = pool.size() + max(pool._max_overflow, 0)
+    return {
+        "size": pool.size(),
+        "checked_out": pool.checkedout(),
+        "overflow": pool.overflow(),
+        "saturation": pool.checkedout() / capacity if capacity else 0,
+        "checkouts": pool.checkouts,
+        "checkout_timeouts": pool.checkout_timeouts,
+        "mean_wait_seconds": pool.total_wait_seconds / pool.checkouts if pool.checkouts else 0,
+        "max_wait_seconds": pool.max_wait_seconds
+    }
+
 
 # Engine used to interface the db
-engine = create_engine(
-    "postgresql://postgres:password@db:5432/garden_db", future=True)
+engine = build_engine(os.environ.get("GARDEN_DB_PROFILE", "manager"))
 
 # Metadata that keeps track of db schema
 metadata = MetaData()
@@ -19,17 +167,45 @@ sensor_table = Table(
     Column("type", String(length=64), nullable=False),
     Column("name", String(length=64), nullable=False),
     Column("unit", String(length=64), nullable=False),
-    Column("sample_gap", Integer, nullable=False)
+    Column("sample_gap", Integer, nullable=False),
+    # Smallest change worth publishing and the longest silence allowed, NULL to publish every reading
+    Column("deadband", Float),
+    Column("heartbeat", Integer),
+    # Range an adaptive sample gap moves in and the change per minute that shrinks it,
+    # NULL for a fixed sample_gap
+    Column("min_gap", Integer),
+    Column("max_gap", Integer),
+    Column("rate_threshold", Float),
+    # Sample gap garden_monitor last reported on sensors/status/{id}
+    Column("effective_gap", Integer),
+    # Calibration curve of ADC sensors, see utils.calibration, NULL for the two-point config
+    Column("calibration", JSON)
 )
 
-# Schema object for samples
+# Schema object for samples, range partitioned by month on timestamp.
+# Partitions are managed by utils.partitions.
 sample_table = Table(
     "sample",
     metadata,
-    Column("id", Integer, primary_key=True),
+    Column("id", Integer, primary_key=True, autoincrement=True),
     Column("sensor_id", ForeignKey("sensor.id"), nullable=False),
-    Column("timestamp", TIMESTAMP, nullable=False),
-    Column("value", Integer, nullable=False)
+    Column("timestamp", TIMESTAMP, primary_key=True, nullable=False),
+    Column("value", Integer, nullable=False),
+    postgresql_partition_by="RANGE (timestamp)"
+)
+
+# Schema object for per-sensor aggregates of samples at minute, hour and day
+# resolution. Maintained by utils.rollups.
+sample_rollup_table = Table(
+    "sample_rollup",
+    metadata,
+    Column("sensor_id", ForeignKey("sensor.id"), primary_key=True),
+    Column("resolution", String(length=16), primary_key=True),
+    Column("bucket", TIMESTAMP, primary_key=True),
+    Column("min", Float, nullable=False),
+    Column("max", Float, nullable=False),
+    Column("sum", Float, nullable=False),
+    Column("count", Integer, nullable=False)
 )
 
 # Schema object for plants
@@ -57,11 +233,6 @@ watering_table = Table(
 )
 
 
-def initialize_db():
-    """Create an instance of the DB if one does not already exist."""
-    metadata.create_all(engine)
-
-
 def _make_generic_database_entry(table, data):
     """Make a new entry in a table with an auto-incremented id."""
     with engine.connect() as conn:
@@ -75,24 +246,49 @@ def _make_generic_database_entry(table, data):
         conn.commit()
 
 
+def upsert_statement(table, data):
+    """Build an INSERT that updates existing rows with the same id.
+
+    Parameters
+    ----------
+    table : str
+        Name of the table to insert into.
+
+    data : dict or list of dict
+        A single row or a list of rows to insert in one statement.
+    """
+    statement = insert(metadata.tables[table]).values(data)
+    # Only overwrite the columns that were provided.
+    columns = (data[0] if isinstance(data, list) else data).keys()
+    return statement.on_conflict_do_update(
+        index_elements=["id"],
+        set_={
+            column: statement.excluded[column]
+            for column in columns
+            if column != "id"
+        }
+    )
+
+
+def update_statement(table, id, data):
+    """Build an UPDATE of the given columns of an existing row.
+
+    Unlike upsert_statement, this does not need the row's required columns.
+    """
+    return update(metadata.tables[table]).where(
+        metadata.tables[table].c.id == id).values(data)
+
+
 def _make_generic_upset_database_entry(table, data):
     """Make a new entry in a table or update an exisiting entry with same id.
 
     Upset is a term for adding a new entry to table or updating an existing entry
     if one already exisits. For iot_herb_garden, exisiting entries are determined
-    by the id field.
+    by the id field. A list of entries is written in a single transaction.
 
     """
     with engine.connect() as conn:
-        conn.execute(
-            insert(
-                metadata.tables[table]
-            ).values(
-                data
-            ).on_duplicate_key_update(
-                data
-            )
-        )
+        conn.execute(upsert_statement(table, data))
         conn.commit()
 
 
@@ -101,6 +297,19 @@ def create_sensor(data):
     _make_generic_upset_database_entry("sensor", data)
 
 
+def update_sensor(sensor_id, data):
+    """Update some columns of an existing sensor in the database."""
+    with engine.connect() as conn:
+        conn.execute(update_statement("sensor", sensor_id, data))
+        conn.commit()
+
+
+def create_plants(data):
+    """Add or update several plants in the database in one transaction."""
+    if data:
+        _make_generic_upset_database_entry("plant", data)
+
+
 def create_sample(data):
     """Log a sample entry in the database."""
     _make_generic_database_entry("sample", data)
@@ -0,0 +1,165 @@
+"""Bounded, non-blocking access to hardware devices.
+
+Each device gets its own worker thread, so a device that hangs or keeps
+failing only delays its own readings. Reads are retried with exponential
+backoff, waited on with a timeout and guarded by a circuit breaker that stops
+calling a device after repeated failures until a cool-down has passed.
+"""
+import concurrent.futures
+import time
+
+
+class device_fault(Exception):
+    """A device read failed, timed out or was refused by the circuit breaker."""
+
+
+class circuit_breaker():
+    """Stop calling a device after consecutive failures.
+
+    The breaker opens after failure_threshold failures in a row. Once
+    reset_timeout seconds have passed, a single trial call is let through;
+    its success closes the breaker and its failure opens it again.
+    """
+
+    def __init__(self, failure_threshold=3, reset_timeout=30.0):
+        """Create a closed breaker."""
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.times_opened = 0
+
+    @property
+    def state(self):
+        """Return closed, open or half_open."""
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            return "half_open"
+        return "open"
+
+    def allow(self):
+        """Return whether a call may be made now."""
+        return self.state != "open"
+
+    def record_success(self):
+        """Close the breaker after a successful call."""
+        self.failures = 0
+        self.opened_at = None
+
+    def record_failure(self):
+        """Count a failed call, opening the breaker at the threshold."""
+        self.failures += 1
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            if self.opened_at is None:
+                self.times_opened += 1
+            # A failed trial call restarts the cool-down.
+            self.opened_at = time.monotonic()
+
+
+class io_worker():
+    """Run the reads of one device on a dedicated thread."""
+
+    def __init__(self, name, retries=2, backoff=0.05, max_backoff=0.5, timeout=1.0,
+                 failure_threshold=3, reset_timeout=30.0):
+        """Create a worker for one device.
+
+        Parameters
+        ----------
+        name : str
+            Name of the device, used for the thread and in errors.
+
+        retries : int
+            Number of times a failed read is retried on the worker thread.
+
+        backoff, max_backoff : float
+            Seconds before the first retry, doubled for each later retry up to max_backoff.
+
+        timeout : float
+            Seconds a caller waits for a read, including its retries.
+
+        failure_threshold, reset_timeout
+            Settings of the device's circuit_breaker.
+        """
+        self.name = name
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.breaker = circuit_breaker(failure_threshold, reset_timeout)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=1, thread_name_prefix=f"io_{name}")
+        self._pending = None
+        self.reads = 0
+        self.retried = 0
+        self.failed = 0
+        self.timed_out = 0
+        self.refused = 0
+
+    def submit(self, function, *args):
+        """Start a read on the worker thread.
+
+        Returns
+        -------
+        concurrent.futures.Future to pass to result.
+
+        Raises
+        ------
+        device_fault if the breaker is open or an earlier read is still stuck.
+        """
+        if not self.breaker.allow():
+            self.refused += 1
+            raise device_fault(f"{self.name} circuit breaker is open")
+        if self._pending is not None and not self._pending.done():
+            self.refused += 1
+            raise device_fault(f"{self.name} is still busy with a timed out read")
+        self._pending = self._executor.submit(self._with_retries, function, *args)
+        return self._pending
+
+    def result(self, future):
+        """Wait up to timeout seconds for a read started by submit.
+
+        Raises
+        ------
+        device_fault if the read failed after its retries or timed out.
+        """
+        self.reads += 1
+        try:
+            value = future.result(self.timeout)
+        except concurrent.futures.TimeoutError:
+            self.timed_out += 1
+            self.breaker.record_failure()
+            raise device_fault(f"{self.name} read timed out after {self.timeout} s")
+        except Exception as error:
+            self.failed += 1
+            self.breaker.record_failure()
+            raise device_fault(f"{self.name} read failed: {error}") from error
+        self.breaker.record_success()
+        return value
+
+    def call(self, function, *args):
+        """Submit a read and wait for its result."""
+        return self.result(self.submit(function, *args))
+
+    def _with_retries(self, function, *args):
+        """Call function, retrying failures with exponential backoff."""
+        for attempt in range(self.retries + 1):
+            try:
+                return function(*args)
+            except Exception:
+                if attempt == self.retries:
+                    raise
+                self.retried += 1
+                time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    def stats(self):
+        """Return the worker's counters as a dict."""
+        return {
+            "state": self.breaker.state,
+            "reads": self.reads,
+            "retried": self.retried,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "refused": self.refused,
+            "times_opened": self.breaker.times_opened
+        }
@@ -0,0 +1,100 @@
+"""Leader election between garden_manager replicas using a Postgres advisory lock.
+
+The same lease decides which replica of each ingest partition is active.
+"""
+import threading
+
+from sqlalchemy import text
+
+from utils.db_interaction import engine
+from utils.logging import mqtt_logger
+
+
+class leader_election():
+    """Hold a session-level advisory lock to decide which replica leads.
+
+    The lock is held on a dedicated connection, so it is released by Postgres
+    as soon as the leader's session ends. Every interval seconds each replica
+    either checks that its session is still alive or tries to take the lock.
+    """
+
+    def __init__(self, lock_id, interval=5.0, on_change=None, name="garden_manager leadership"):
+        """Create a new election and start campaigning.
+
+        Parameters
+        ----------
+        lock_id : int
+            Advisory lock key shared by all replicas.
+
+        interval : float
+            Seconds between lock attempts and liveness checks.
+
+        on_change : callable
+            Called with True or False from the election thread whenever
+            leadership is gained or lost.
+
+        name : str
+            What the lock stands for, used in log messages.
+        """
+        self.lock_id = lock_id
+        self.name = name
+        self.interval = interval
+        self.on_change = on_change
+        self.is_leader = False
+        self._conn = None
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name=f"election_{lock_id}", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop campaigning and release the lock if held."""
+        self._stopped.set()
+        self._thread.join()
+        self._set_leader(False)
+        if self._conn is not None:
+            # Discard the connection instead of pooling it so the session, and
+            # with it the lock, ends immediately.
+            self._conn.invalidate()
+            self._conn.close()
+
+    def _run(self):
+        """Try to take or keep the lock until stopped."""
+        while not self._stopped.is_set():
+            try:
+                self._campaign()
+            except Exception as error:
+                mqtt_logger.warning(f"Leader election failed: {error}")
+                self._set_leader(False)
+                if self._conn is not None:
+                    self._conn.invalidate()
+                    self._conn.close()
+                    self._conn = None
+            self._stopped.wait(self.interval)
+
+    def _campaign(self):
+        """Take the lock if it is free or check the session holding it."""
+        if self._conn is None:
+            self._conn = engine.connect()
+            # Keep the connection out of a transaction so the lock is session scoped.
+            self._conn.execution_options(isolation_level="AUTOCOMMIT")
+
+        if self.is_leader:
+            self._conn.execute(text("SELECT 1"))
+        else:
+            acquired = self._conn.execute(
+                text("SELECT pg_try_advisory_lock(:lock_id)"),
+                {"lock_id": self.lock_id}
+            ).scalar()
+            if acquired:
+                self._set_leader(True)
+
+    def _set_leader(self, is_leader):
+        """Update leadership and notify on_change if it changed."""
+        if is_leader == self.is_leader:
+            return
+        self.is_leader = is_leader
+        mqtt_logger.info(
+            f"Acquired {self.name}" if is_leader else f"Lost {self.name}")
+        if self.on_change:
+            self.on_change(is_leader)
@@ -0,0 +1,121 @@
+"""In-process cache of sensor and plant metadata for garden_manager."""
+import threading
+
+from sqlalchemy import select
+
+from utils.db_interaction import engine, plant_table, sensor_table
+
+
+class metadata_cache():
+    """Sensor and plant rows indexed by sensor_id and plant_id.
+
+    The cache is loaded once from the database and then kept up to date from
+    the config messages garden_manager processes, so the sample path never
+    has to query the sensor or plant tables.
+    """
+
+    def __init__(self):
+        """Create an empty cache."""
+        self._lock = threading.Lock()
+        self.sensors = {}
+        self.plants = {}
+        self.plants_by_sensor = {}
+
+    def load(self):
+        """Replace the cache contents with the current rows in the database."""
+        with engine.connect() as conn:
+            sensor_rows = conn.execute(select(sensor_table)).fetchall()
+            plant_rows = conn.execute(select(plant_table)).fetchall()
+        self.populate(sensor_rows, plant_rows)
+
+    def populate(self, sensor_rows, plant_rows):
+        """Replace the cache contents with the given sensor and plant rows."""
+        with self._lock:
+            self.sensors = {}
+            self.plants = {}
+            self.plants_by_sensor = {}
+        for row in sensor_rows:
+            self.update_sensor(dict(row._mapping))
+        for row in plant_rows:
+            self.update_plant(dict(row._mapping))
+
+    def update_sensor(self, data):
+        """Add or update a sensor from a sensors/config payload or DB row."""
+        sensor = dict(data)
+        sensor["id"] = int(sensor["id"])
+        with self._lock:
+            self.sensors[sensor["id"]] = {
+                **self.sensors.get(sensor["id"], {}), **sensor}
+
+    def update_plant(self, data):
+        """Add or update a plant from a plants/config payload or DB row."""
+        plant = dict(data)
+        plant["id"] = int(plant["id"])
+        plant["humidity_sensor_id"] = int(plant["humidity_sensor_id"])
+        with self._lock:
+            old_plant = self.plants.get(plant["id"])
+            if old_plant and self.plants_by_sensor.get(old_plant["humidity_sensor_id"]) is old_plant:
+                del self.plants_by_sensor[old_plant["humidity_sensor_id"]]
+            plant = {**(old_plant or {}), **plant}
+            self.plants[plant["id"]] = plant
+            self.plants_by_sensor[plant["humidity_sensor_id"]] = plant
+
+    def watering_rules(self):
+        """Compile the watering rule of every plant for garden_monitor, keyed by soil sensor_id."""
+        with self._lock:
+            return {
+                str(plant["humidity_sensor_id"]): {
+                    "plant_id": plant["id"],
+                    "pump_id": str(plant["pump_id"]),
+                    "target": plant["target"],
+                    "tolerance": plant["humidity_tolerance"],
+                    "cooldown": plant["watering_cooldown"],
+                    "duration": plant["watering_duration"]
+                }
+                for plant in self.plants.values()
+            }
+
+    def sensor(self, sensor_id):
+        """Return the cached sensor with the given id or None."""
+        return self.sensors.get(int(sensor_id))
+
+    def plant(self, plant_id):
+        """Return the cached plant with the given id or None."""
+        return self.plants.get(int(plant_id))
+
+    def plant_for_sensor(self, sensor_id):
+        """Return the cached plant watered based on the given sensor or None."""
+        return self.plants_by_sensor.get(int(sensor_id))
+
+    def sensor_ids(self, type=None):
+        """Return the ids of all cached sensors, optionally filtered by type."""
+        with self._lock:
+            return [id for id, sensor in self.sensors.items()
+                    if type is None or sensor["type"] == type]
+
+    def missing_plants(self):
+        """Return default plant rows for soil_humidity sensors without a plant.
+
+        New plants are allocated ids after the highest known plant id in
+        ascending sensor_id order, so the result only depends on the cache.
+        """
+        with self._lock:
+            next_id = max(list(self.plants) + [0]) + 1
+            orphans = sorted(
+                id for id, sensor in self.sensors.items()
+                if sensor["type"] == "soil_humidity" and id not in self.plants_by_sensor
+            )
+        plants = []
+        for new_id, humidity_sensor_id in enumerate(orphans, start=next_id):
+            # Plant with default values
+            plants.append({
+                "id": new_id,
+                "name": f"plant_{new_id}",
+                "humidity_sensor_id": humidity_sensor_id,
+                "pump_id": new_id,
+                "target": 50,
+                "watering_cooldown": 300,
+                "watering_duration": 1,
+                "humidity_tolerance": 5
+            })
+        return plants
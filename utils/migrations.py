@@ -0,0 +1,208 @@
+"""Versioned schema migrations for the garden database.
+
+Each migration is applied once, in version order, and recorded in the
+schema_version table. Run this module directly to bring a database up to date:
+
+    python -m utils.migrations
+
+"""
+from datetime import datetime as dt
+
+from sqlalchemy import text
+
+from utils.db_interaction import engine, metadata, sample_rollup_table
+from utils.logging import config_logger
+from utils.partitions import create_sample_partitions, month_start
+
+# Advisory lock key that serializes migrations between manager replicas
+migration_lock_id = 0x6d696772617465
+
+
+def _create_schema(conn):
+    """Create every table described in utils.db_interaction that does not exist yet."""
+    metadata.create_all(conn)
+
+
+def _create_index(conn, name, table, definition):
+    """Create an index without blocking writes to an existing table.
+
+    An invalid index left behind by an interrupted concurrent build is
+    dropped and built again. Partitioned tables do not support concurrent
+    builds, so their index is created normally.
+    """
+    valid = conn.execute(
+        text("SELECT i.indisvalid FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+             "WHERE c.relname = :name"),
+        {"name": name}
+    ).scalar()
+    if valid:
+        return
+    if valid is False:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+
+    partitioned = conn.execute(
+        text("SELECT relkind = 'p' FROM pg_class WHERE relname = :table"),
+        {"table": table}
+    ).scalar()
+    concurrently = "" if partitioned else "CONCURRENTLY "
+    conn.execute(
+        text(f"CREATE INDEX {concurrently}IF NOT EXISTS {name} ON {table} {definition}"))
+
+
+def _add_time_series_indexes(conn):
+    """Index samples and watering events for the history and overview queries."""
+    _create_index(conn, "ix_sample_sensor_id_timestamp",
+                  "sample", "(sensor_id, timestamp)")
+    _create_index(conn, "ix_watering_event_plant_id_timestamp",
+                  "watering_event", "(plant_id, timestamp)")
+    _create_index(conn, "ix_sample_timestamp_brin",
+                  "sample", "USING brin (timestamp)")
+
+
+def _partition_sample_table(conn):
+    """Convert sample into a table range partitioned by month.
+
+    An existing unpartitioned sample table is renamed and attached unchanged as
+    the partition for everything before next month, so no rows are copied.
+    A default partition catches samples outside of the monthly partitions.
+    """
+    partitioned = conn.execute(
+        text("SELECT relkind = 'p' FROM pg_class WHERE relname = 'sample'")
+    ).scalar()
+
+    if not partitioned:
+        boundary = month_start(dt.now(), 1).isoformat()
+        conn.execute(text("ALTER TABLE sample RENAME TO sample_legacy"))
+        conn.execute(text("ALTER INDEX sample_pkey RENAME TO sample_legacy_pkey"))
+        conn.execute(text(
+            "ALTER INDEX IF EXISTS ix_sample_sensor_id_timestamp "
+            "RENAME TO ix_sample_legacy_sensor_id_timestamp"))
+        conn.execute(text(
+            "ALTER INDEX IF EXISTS ix_sample_timestamp_brin "
+            "RENAME TO ix_sample_legacy_timestamp_brin"))
+        conn.execute(text(
+            "CREATE TABLE sample ("
+            "id INTEGER NOT NULL DEFAULT nextval('sample_id_seq'), "
+            "sensor_id INTEGER NOT NULL REFERENCES sensor (id), "
+            "timestamp TIMESTAMP NOT NULL, "
+            "value INTEGER NOT NULL, "
+            "PRIMARY KEY (id, timestamp)"
+            ") PARTITION BY RANGE (timestamp)"
+        ))
+        conn.execute(text("ALTER SEQUENCE sample_id_seq OWNED BY sample.id"))
+        # The check constraint lets ATTACH skip its own validation scan.
+        conn.execute(text(
+            f"ALTER TABLE sample_legacy ADD CONSTRAINT sample_legacy_range "
+            f"CHECK (timestamp < '{boundary}')"))
+        conn.execute(text(
+            f"ALTER TABLE sample ATTACH PARTITION sample_legacy "
+            f"FOR VALUES FROM (MINVALUE) TO ('{boundary}')"))
+
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS sample_default PARTITION OF sample DEFAULT"))
+    create_sample_partitions(conn)
+    # Indexes on the parent attach to the renamed legacy indexes instead of rebuilding them.
+    _add_time_series_indexes(conn)
+
+
+def _create_rollup_table(conn):
+    """Create the sample_rollup table, run python -m utils.rollups backfill afterwards."""
+    sample_rollup_table.create(conn, checkfirst=True)
+
+
+def _add_sensor_reporting_columns(conn):
+    """Add the deadband and heartbeat settings of report-by-exception publishing to sensor."""
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS deadband DOUBLE PRECISION"))
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS heartbeat INTEGER"))
+
+
+def _add_adaptive_sampling_columns(conn):
+    """Add the adaptive sampling settings and the reported effective gap to sensor."""
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS min_gap INTEGER"))
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS max_gap INTEGER"))
+    conn.execute(text(
+        "ALTER TABLE sensor ADD COLUMN IF NOT EXISTS rate_threshold DOUBLE PRECISION"))
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS effective_gap INTEGER"))
+
+
+def _add_sensor_calibration_column(conn):
+    """Add the calibration curve of ADC sensors to sensor."""
+    conn.execute(text("ALTER TABLE sensor ADD COLUMN IF NOT EXISTS calibration JSON"))
+
+
+# Every migration as (version, description, function, transactional).
+# Non-transactional migrations run in autocommit mode and must be safe to rerun.
+migrations = [
+    (1, "Create the initial schema", _create_schema, True),
+    (2, "Add time-series indexes", _add_time_series_indexes, False),
+    (3, "Partition sample by month", _partition_sample_table, True),
+    (4, "Add sample rollups", _create_rollup_table, True),
+    (5, "Add sensor deadband and heartbeat", _add_sensor_reporting_columns, True),
+    (6, "Add adaptive sample gaps", _add_adaptive_sampling_columns, True),
+    (7, "Add sensor calibration curves", _add_sensor_calibration_column, True)
+]
+
+
+def current_version(conn):
+    """Return the latest applied migration version, 0 for a new database."""
+    return conn.execute(
+        text("SELECT coalesce(max(version), 0) FROM schema_version")
+    ).scalar()
+
+
+def _record(conn, version, description):
+    """Mark a migration as applied."""
+    conn.execute(
+        text("INSERT INTO schema_version (version, description) "
+             "VALUES (:version, :description)"),
+        {"version": version, "description": description}
+    )
+
+
+def migrate():
+    """Apply every pending migration to the database."""
+    with engine.connect() as lock_conn:
+        # Hold the lock on its own session so migrations can use other connections.
+        lock_conn.execution_options(isolation_level="AUTOCOMMIT")
+        lock_conn.execute(text("SELECT pg_advisory_lock(:lock_id)"),
+                          {"lock_id": migration_lock_id})
+        try:
+            with engine.begin() as conn:
+                conn.execute(text(
+                    "CREATE TABLE IF NOT EXISTS schema_version ("
+                    "version INTEGER PRIMARY KEY, "
+                    "description VARCHAR(256) NOT NULL, "
+                    "applied_at TIMESTAMP NOT NULL DEFAULT now())"
+                ))
+                version = current_version(conn)
+
+            for migration_version, description, function, transactional in migrations:
+                if migration_version <= version:
+                    continue
+                config_logger.info(
+                    f"Applying migration {migration_version}: {description}")
+                if transactional:
+                    # A failure rolls back the whole migration.
+                    with engine.begin() as conn:
+                        # Migrations may run longer than the profile's statement timeout.
+                        conn.execute(text("SET LOCAL statement_timeout = 0"))
+                        function(conn)
+                        _record(conn, migration_version, description)
+                else:
+                    with engine.connect() as conn:
+                        conn.execution_options(isolation_level="AUTOCOMMIT")
+                        conn.execute(text("SET statement_timeout = 0"))
+                        try:
+                            function(conn)
+                            _record(conn, migration_version, description)
+                        finally:
+                            conn.execute(text("RESET statement_timeout"))
+                version = migration_version
+            config_logger.info(f"Database schema is at version {version}")
+        finally:
+            lock_conn.execute(text("SELECT pg_advisory_unlock(:lock_id)"),
+                              {"lock_id": migration_lock_id})
+
+
+if __name__ == "__main__":
+    migrate()
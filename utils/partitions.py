@@ -0,0 +1,162 @@
+"""Management of the monthly range partitions of the sample table."""
+import re
+from datetime import datetime as dt
+
+from sqlalchemy import exc, text
+
+from utils.db_interaction import engine
+from utils.logging import config_logger
+
+# Bounds of a partition as reported by pg_get_expr(relpartbound)
+_bound_pattern = re.compile(
+    r"FROM \((?:'(?P<lower>[^']+)'|MINVALUE)\) TO \((?:'(?P<upper>[^']+)'|MAXVALUE)\)")
+
+
+def month_start(timestamp, offset=0):
+    """Return midnight on the first day of the month offset months after timestamp."""
+    month = timestamp.year * 12 + timestamp.month - 1 + offset
+    return dt(month // 12, month % 12 + 1, 1)
+
+
+def partition_name(start):
+    """Return the name of the partition holding the month beginning at start."""
+    return f"sample_y{start.year:04d}m{start.month:02d}"
+
+
+def sample_partitions(conn):
+    """Return (name, lower, upper) for every range partition of the sample table.
+
+    lower is None for a partition starting at MINVALUE and upper is None for one
+    ending at MAXVALUE. The default partition is not included.
+    """
+    result = conn.execute(text(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) "
+        "FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'sample'::regclass"
+    )).fetchall()
+    partitions = []
+    for name, bound in result:
+        match = _bound_pattern.search(bound)
+        if not match:
+            continue
+        lower, upper = match.group("lower"), match.group("upper")
+        partitions.append((
+            name,
+            dt.fromisoformat(lower) if lower else None,
+            dt.fromisoformat(upper) if upper else None
+        ))
+    return sorted(partitions, key=lambda partition: partition[1] or dt.min)
+
+
+def _covered(partitions, start):
+    """Return whether an existing partition already holds the month beginning at start."""
+    return any((lower is None or lower <= start) and (upper is None or start < upper)
+               for name, lower, upper in partitions)
+
+
+def _default_rows(conn, start, end):
+    """Return whether the default partition holds samples between start and end."""
+    if conn.execute(text("SELECT to_regclass('sample_default')")).scalar() is None:
+        return False
+    return conn.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM sample_default "
+        "WHERE timestamp >= :start AND timestamp < :end)"),
+        {"start": start, "end": end}
+    ).scalar()
+
+
+def create_sample_partitions(conn, months_ahead=3):
+    """Create the partitions for the current month and the next months_ahead months.
+
+    Postgres refuses to create a partition for a range the default partition
+    already holds rows in, e.g. when the manager was down over a month
+    boundary. Those rows are moved into the new partition, which is then
+    attached, all within the caller's transaction.
+
+    Parameters
+    ----------
+    conn : sqlalchemy.engine.Connection
+        Connection to create the partitions with, in a transaction.
+
+    months_ahead : int
+        Number of future months to create partitions for.
+
+    Returns
+    -------
+    List of the names of the partitions that were created.
+    """
+    partitions = sample_partitions(conn)
+    created = []
+    for offset in range(months_ahead + 1):
+        start = month_start(dt.now(), offset)
+        if _covered(partitions, start):
+            continue
+        name = partition_name(start)
+        end = month_start(start, 1)
+        bounds = f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        if _default_rows(conn, start, end):
+            conn.execute(text(
+                f"CREATE TABLE {name} (LIKE sample INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+            moved = conn.execute(text(
+                f"WITH moved AS (DELETE FROM sample_default "
+                f"WHERE timestamp >= :start AND timestamp < :end RETURNING *) "
+                f"INSERT INTO {name} SELECT * FROM moved"),
+                {"start": start, "end": end}
+            ).rowcount
+            conn.execute(text(f"ALTER TABLE sample ATTACH PARTITION {name} {bounds}"))
+            config_logger.info(
+                f"Moved {moved} samples from sample_default into {name}")
+        else:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF sample {bounds}"))
+        created.append(name)
+    return created
+
+
+def ensure_sample_partitions(months_ahead=3):
+    """Create any missing partitions for the coming months in their own transaction.
+
+    A failure is logged rather than raised, so the next periodic run retries it.
+    """
+    try:
+        with engine.begin() as conn:
+            created = create_sample_partitions(conn, months_ahead)
+    except exc.SQLAlchemyError as error:
+        config_logger.error(f"Failed to create sample partitions: {error}")
+        return []
+    if created:
+        config_logger.info(f"Created sample partitions {created}")
+    return created
+
+
+def detach_sample_partitions(before, drop=False):
+    """Detach every partition whose months all lie before the given time.
+
+    Detaching only changes the catalog, so old samples are removed without a
+    bulk DELETE. Detached tables are kept for archiving unless drop is set.
+
+    Parameters
+    ----------
+    before : datetime
+        Partitions ending at or before this time are detached.
+
+    drop : bool
+        Drop the detached tables instead of keeping them.
+
+    Returns
+    -------
+    List of the names of the partitions that were detached.
+    """
+    detached = []
+    with engine.begin() as conn:
+        for name, lower, upper in sample_partitions(conn):
+            if upper is None or upper > before:
+                continue
+            conn.execute(text(f"ALTER TABLE sample DETACH PARTITION {name}"))
+            if drop:
+                conn.execute(text(f"DROP TABLE {name}"))
+            detached.append(name)
+    if detached:
+        config_logger.info(
+            f"{'Dropped' if drop else 'Detached'} sample partitions {detached}")
+    return detached
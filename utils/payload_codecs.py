@@ -0,0 +1,174 @@
+"""Codecs for the payloads of sample messages.
+
+JSON on sensors/data/{id} stays the default. Other codecs are selected by
+adding the codec name as a suffix to the topic, e.g. sensors/data/{id}/struct.
+Batches of samples from several sensors are published on sensors/batch with
+the same suffix convention.
+
+Binary codecs carry the timestamp as milliseconds since the epoch of the
+sender's wall clock, so naive timestamps decode to the same value the JSON
+codec would produce. Samples may carry a per-sensor sequence number under the
+seq key, see utils.sequence_tracker.
+"""
+import json
+import struct
+from datetime import datetime as dt
+from datetime import timedelta
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Naive epoch used for wall clock milliseconds
+_epoch = dt(1970, 1, 1)
+
+
+def to_epoch_ms(timestamp):
+    """Convert a naive datetime to wall clock milliseconds since the epoch."""
+    return (timestamp - _epoch) // timedelta(milliseconds=1)
+
+
+def from_epoch_ms(milliseconds):
+    """Convert wall clock milliseconds since the epoch to a naive datetime."""
+    return _epoch + timedelta(milliseconds=milliseconds)
+
+
+class json_codec():
+    """The original JSON payload with an ISO timestamp."""
+
+    name = "json"
+
+    def encode_sample(self, sample):
+        """Encode a dict with value and datetime timestamp keys."""
+        return json.dumps({**sample, "timestamp": sample["timestamp"].isoformat()})
+
+    def decode_sample(self, payload):
+        """Decode a payload into a dict with value and datetime timestamp keys."""
+        sample = json.loads(payload)
+        sample["timestamp"] = dt.fromisoformat(sample["timestamp"])
+        return sample
+
+    def encode_batch(self, samples):
+        """Encode a list of dicts with sensor_id, value and datetime timestamp keys."""
+        return json.dumps([{**sample, "timestamp": sample["timestamp"].isoformat()}
+                           for sample in samples])
+
+    def decode_batch(self, payload):
+        """Decode a payload into a list of dicts with sensor_id, value and timestamp keys."""
+        samples = json.loads(payload)
+        for sample in samples:
+            sample["timestamp"] = dt.fromisoformat(sample["timestamp"])
+        return samples
+
+
+class msgpack_codec():
+    """MessagePack map with an epoch millisecond timestamp."""
+
+    name = "msgpack"
+
+    def encode_sample(self, sample):
+        """Encode a dict with value and datetime timestamp keys."""
+        return msgpack.packb({**sample, "timestamp": to_epoch_ms(sample["timestamp"])})
+
+    def decode_sample(self, payload):
+        """Decode a payload into a dict with value and datetime timestamp keys."""
+        sample = msgpack.unpackb(payload)
+        sample["timestamp"] = from_epoch_ms(sample["timestamp"])
+        return sample
+
+    def encode_batch(self, samples):
+        """Encode a list of dicts with sensor_id, value and datetime timestamp keys."""
+        return msgpack.packb([{**sample, "timestamp": to_epoch_ms(sample["timestamp"])}
+                              for sample in samples])
+
+    def decode_batch(self, payload):
+        """Decode a payload into a list of dicts with sensor_id, value and timestamp keys."""
+        samples = msgpack.unpackb(payload)
+        for sample in samples:
+            sample["timestamp"] = from_epoch_ms(sample["timestamp"])
+        return samples
+
+
+class struct_codec():
+    """Fixed 20 byte layout: little-endian int64 epoch milliseconds, float32 value
+    and uint64 sequence number, 0 for a sample without one.
+
+    Batches are a sequence of 22 byte records that prefix the same layout
+    with a uint16 sensor_id.
+    """
+
+    name = "struct"
+    layout = struct.Struct("<qfQ")
+    batch_layout = struct.Struct("<HqfQ")
+
+    def encode_sample(self, sample):
+        """Encode a dict with value, datetime timestamp and optional seq keys."""
+        return self.layout.pack(to_epoch_ms(sample["timestamp"]), sample["value"],
+                                sample.get("seq") or 0)
+
+    def decode_sample(self, payload):
+        """Decode a payload into a dict with value, datetime timestamp and optional seq keys."""
+        milliseconds, value, seq = self.layout.unpack(payload)
+        return self._sample(milliseconds, value, seq)
+
+    def encode_batch(self, samples):
+        """Encode a list of dicts with sensor_id, value, datetime timestamp and optional seq keys."""
+        return b"".join(
+            self.batch_layout.pack(int(sample["sensor_id"]),
+                                   to_epoch_ms(sample["timestamp"]), sample["value"],
+                                   sample.get("seq") or 0)
+            for sample in samples)
+
+    def decode_batch(self, payload):
+        """Decode a payload into a list of dicts with sensor_id, value, timestamp and optional seq keys."""
+        return [
+            {"sensor_id": sensor_id, **self._sample(milliseconds, value, seq)}
+            for sensor_id, milliseconds, value, seq in self.batch_layout.iter_unpack(payload)
+        ]
+
+    def _sample(self, milliseconds, value, seq):
+        """Build a sample dict from unpacked fields."""
+        # float32 cannot hold every two decimal reading exactly.
+        sample = {"timestamp": from_epoch_ms(milliseconds), "value": round(value, 2)}
+        if seq:
+            sample["seq"] = seq
+        return sample
+
+
+# Available codecs by name, MessagePack only if it is installed
+codecs = {codec.name: codec for codec in [json_codec(), struct_codec()]}
+if msgpack is not None:
+    codecs[msgpack_codec.name] = msgpack_codec()
+
+
+def sample_topic(sensor_id, codec_name="json"):
+    """Return the topic to publish a sensor's samples on with the given codec."""
+    if codec_name == "json":
+        return f"sensors/data/{sensor_id}"
+    return f"sensors/data/{sensor_id}/{codec_name}"
+
+
+def batch_topic(codec_name="json"):
+    """Return the topic to publish batches of samples on with the given codec."""
+    if codec_name == "json":
+        return "sensors/batch"
+    return f"sensors/batch/{codec_name}"
+
+
+def parse_batch_topic(topic):
+    """Return the codec of a batch topic."""
+    levels = topic.split("/")
+    return codecs[levels[2] if len(levels) > 2 else "json"]
+
+
+def parse_sample_topic(topic):
+    """Return the sensor_id and codec of a sample topic.
+
+    Raises
+    ------
+    KeyError if the topic names a codec that is not available.
+    """
+    levels = topic.split("/")
+    codec_name = levels[3] if len(levels) > 3 else "json"
+    return int(levels[2]), codecs[codec_name]
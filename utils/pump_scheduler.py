@@ -0,0 +1,207 @@
+"""Queue of pump commands run within a budget of concurrently running pumps."""
+import math
+import numbers
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime as dt
+
+from utils.logging import pump_logger
+
+# Actions a pump command can carry
+PUMP_ACTIONS = ["run", "replace", "cancel"]
+
+
+class pump_scheduler():
+    """Run queued pump commands on a single thread, at most max_concurrent pumps at a time.
+
+    Commands for a pump that is already queued are merged into the queued
+    command, which keeps its place in the FIFO queue:
+
+    - run: queue the pump, keeping the longer of the two durations if it is
+      already queued.
+    - replace: queue the pump with the new duration, replacing a queued one.
+    - cancel: drop the queued command and stop the pump if it is running.
+    """
+
+    def __init__(self, pumps, max_concurrent=1, on_event=None, on_state=None):
+        """Create a scheduler and start its thread.
+
+        Parameters
+        ----------
+        pumps : dict
+            Output devices with on() and off() methods by pump_id.
+
+        max_concurrent : int
+            Maximum number of pumps running at once, e.g. to stay within the
+            current the power supply can deliver.
+
+        on_event : function
+            Called with a dict describing each completed run of a pump.
+
+        on_state : function
+            Called with the dict returned by state whenever it changes.
+        """
+        self.pumps = pumps
+        self.max_concurrent = max_concurrent
+        self.on_event = on_event
+        self.on_state = on_state
+
+        # pump_id -> requested duration, in the order the pumps were queued
+        self._queued = OrderedDict()
+        # pump_id -> (monotonic stop time, start datetime, requested duration)
+        self._running = {}
+        self._condition = threading.Condition()
+        self._stopped = False
+        self.merged = 0
+        self.cancelled = 0
+
+        self._thread = threading.Thread(
+            target=self._run, name="pump_scheduler", daemon=True)
+        self._thread.start()
+
+    def submit(self, pump_id, duration=0, action="run"):
+        """Queue, replace or cancel a command for a pump.
+
+        Raises
+        ------
+        ValueError if the pump or action is unknown, or the duration is not a
+        number of seconds of at least 0.
+        """
+        if pump_id not in self.pumps:
+            raise ValueError(f"Unknown pump {pump_id}")
+        if action not in PUMP_ACTIONS:
+            raise ValueError(
+                f"Unknown pump action {action}, expected one of {PUMP_ACTIONS}")
+        if isinstance(duration, bool) or not isinstance(duration, numbers.Real) \
+                or not math.isfinite(duration) or duration < 0:
+            raise ValueError(f"Invalid pump duration {duration!r}, expected seconds of at least 0")
+        with self._condition:
+            if action == "cancel":
+                if self._queued.pop(pump_id, None) is not None:
+                    self.cancelled += 1
+                if pump_id in self._running:
+                    # Stop the running pump on the next pass.
+                    stop_at, started, requested = self._running[pump_id]
+                    self._running[pump_id] = (0, started, requested)
+            elif pump_id in self._queued:
+                self.merged += 1
+                self._queued[pump_id] = duration if action == "replace" \
+                    else max(self._queued[pump_id], duration)
+            else:
+                self._queued[pump_id] = duration
+            self._condition.notify()
+
+    def cancel(self, pump_id):
+        """Drop a pump's queued command and stop it if it is running."""
+        self.submit(pump_id, action="cancel")
+
+    def state(self):
+        """Return the running pumps with their remaining seconds and the queued commands."""
+        with self._condition:
+            return self._state()
+
+    def stop(self):
+        """Stop the scheduler thread and switch every running pump off."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+
+    def _state(self):
+        """Build the state dict, the condition must be held."""
+        now = time.monotonic()
+        return {
+            "running": {id: round(max(stop_at - now, 0), 1)
+                        for id, (stop_at, started, requested) in self._running.items()},
+            "queued": [{"pump_id": id, "duration": duration}
+                       for id, duration in self._queued.items()],
+            "max_concurrent": self.max_concurrent
+        }
+
+    def _run(self):
+        """Run scheduler passes until stopped, switching every pump off after an error."""
+        while True:
+            try:
+                if self._step():
+                    return
+            except Exception as error:
+                pump_logger.exception(f"Pump scheduler failed: {error}")
+                with self._condition:
+                    for id, (stop_at, started, requested) in list(self._running.items()):
+                        self._switch_off(id, started, requested)
+                if self._stopped:
+                    return
+
+    def _step(self):
+        """Switch pumps off when their time is up and start queued pumps while within budget.
+
+        Returns
+        -------
+        True once the scheduler has been stopped.
+        """
+        events = []
+        with self._condition:
+            now = time.monotonic()
+            changed = False
+            for id, (stop_at, started, requested) in list(self._running.items()):
+                if stop_at <= now or self._stopped:
+                    events.append(self._switch_off(id, started, requested))
+                    changed = True
+            for id in list(self._queued):
+                if self._stopped or len(self._running) >= self.max_concurrent:
+                    break
+                if id in self._running:
+                    # A pump queued again while running waits for its current run to end.
+                    continue
+                duration = self._queued.pop(id)
+                # Register the deadline first, so the pump is switched off
+                # even if switching it on fails halfway.
+                started = dt.now()
+                self._running[id] = (now + duration, started, duration)
+                changed = True
+                try:
+                    self.pumps[id].on()
+                except Exception as error:
+                    pump_logger.exception(f"Failed to activate pump {id}: {error}")
+                    self._switch_off(id, started, duration)
+                    continue
+                pump_logger.info(f"Pump {id} activated for {duration} s")
+            state = self._state() if changed else None
+            if not self._stopped:
+                deadlines = [stop_at for stop_at, started,
+                             requested in self._running.values()]
+                if not changed:
+                    self._condition.wait(
+                        min(deadlines) - now if deadlines else None)
+        for event in events:
+            self._notify(self.on_event, event)
+        if state:
+            self._notify(self.on_state, state)
+        return self._stopped
+
+    def _notify(self, callback, argument):
+        """Call on_event or on_state, logging its errors so the thread keeps running."""
+        if callback:
+            try:
+                callback(argument)
+            except Exception as error:
+                pump_logger.exception(f"Pump callback failed: {error}")
+
+    def _switch_off(self, pump_id, started, requested):
+        """Switch a running pump off and describe the run, the condition must be held."""
+        try:
+            self.pumps[pump_id].off()
+        except Exception as error:
+            pump_logger.exception(f"Failed to deactivate pump {pump_id}: {error}")
+        stopped = dt.now()
+        del self._running[pump_id]
+        duration = (stopped - started).total_seconds()
+        pump_logger.info(f"Pump {pump_id} deactivated after {duration:.1f} s")
+        return {
+            "pump_id": pump_id,
+            "started": started,
+            "stopped": stopped,
+            "duration": duration,
+            "requested_duration": requested
+        }
@@ -0,0 +1,55 @@
+"""MQTT QoS levels for each class of topic.
+
+Losing or duplicating a single sample does little harm and the manager
+detects both from sequence numbers, so data topics default to QoS 1.
+Pump control and config stay at QoS 2. Each class can be overridden with a
+QOS_<CLASS> environment variable, e.g. QOS_DATA=0.
+"""
+import os
+
+import paho.mqtt.client as mqtt
+
+# Default QoS level of every topic class
+default_levels = {
+    "data": 1,
+    "control": 2,
+    "config": 2,
+    "status": 1
+}
+
+# Topic class of every topic filter used by the garden
+topic_classes = {
+    "sensors/data/#": "data",
+    "sensors/batch/#": "data",
+    "garden_manager/watering": "data",
+    "pumps/control/+": "control",
+    "pumps/event/+": "control",
+    "sensors/config": "config",
+    "sensors/info": "config",
+    "plants/config": "config",
+    "plants/rules": "config",
+    "status/+": "status",
+    "sensors/status/+": "status",
+    "pumps/status": "status"
+}
+
+
+def level(topic_class):
+    """Return the QoS level of a topic class."""
+    return int(os.environ.get(f"QOS_{topic_class.upper()}", default_levels[topic_class]))
+
+
+def qos(topic):
+    """Return the QoS level to publish or subscribe to a topic or topic filter with.
+
+    Raises
+    ------
+    KeyError if the topic does not belong to a known topic class.
+    """
+    if topic.startswith("$share/"):
+        # Drop the $share/{group} prefix of shared subscriptions.
+        topic = topic.split("/", 2)[2]
+    for topic_filter, topic_class in topic_classes.items():
+        if mqtt.topic_matches_sub(topic_filter, topic):
+            return level(topic_class)
+    raise KeyError(f"No QoS policy for topic {topic}")
@@ -0,0 +1,147 @@
+"""Enforcement of the data retention policies in retention_policy.yaml.
+
+Expired rows are deleted in small batches, each in its own transaction, so
+the job never holds locks for long. Whole sample partitions that every
+policy has expired are dropped instead of deleted row by row.
+"""
+import time
+from datetime import datetime as dt
+from datetime import timedelta
+
+import yaml
+from sqlalchemy import select, text
+
+from utils.db_interaction import engine, sensor_table
+from utils.logging import config_logger
+from utils.partitions import detach_sample_partitions, sample_partitions
+from utils.rollups import resolutions
+
+
+def read_policies(path="retention_policy.yaml"):
+    """Read the retention policies from a YAML file."""
+    with open(path, "r") as policy_file:
+        return yaml.safe_load(policy_file.read())
+
+
+def sample_policy(policies, sensor_type):
+    """Return the days to keep for raw samples and each rollup resolution of a sensor type."""
+    sample_policies = policies.get("samples") or {}
+    return {
+        **(sample_policies.get("default") or {}),
+        **(sample_policies.get(sensor_type) or {})
+    }
+
+
+def _delete_in_batches(statement, params, batch_size, pause):
+    """Run a batched DELETE until it deletes fewer rows than batch_size.
+
+    Returns
+    -------
+    Total number of rows deleted.
+    """
+    deleted = 0
+    while True:
+        with engine.begin() as conn:
+            count = conn.execute(
+                statement, {**params, "batch_size": batch_size}).rowcount
+        deleted += count
+        if count < batch_size:
+            return deleted
+        # Give other writers a chance at the locks between batches.
+        time.sleep(pause)
+
+
+_delete_samples = text(
+    "DELETE FROM sample WHERE (id, timestamp) IN ("
+    "SELECT id, timestamp FROM sample "
+    "WHERE sensor_id = ANY(:sensor_ids) AND timestamp < :cutoff "
+    "LIMIT :batch_size)"
+)
+
+_delete_rollups = text(
+    "DELETE FROM sample_rollup WHERE (sensor_id, resolution, bucket) IN ("
+    "SELECT sensor_id, resolution, bucket FROM sample_rollup "
+    "WHERE sensor_id = ANY(:sensor_ids) AND resolution = :resolution AND bucket < :cutoff "
+    "LIMIT :batch_size)"
+)
+
+_delete_watering_events = text(
+    "DELETE FROM watering_event WHERE id IN ("
+    "SELECT id FROM watering_event WHERE timestamp < :cutoff "
+    "LIMIT :batch_size)"
+)
+
+
+def enforce_retention(policies, batch_size=5000, pause=0.1):
+    """Delete data older than the retention policies allow.
+
+    Parameters
+    ----------
+    policies : dict
+        Policies as read by read_policies.
+
+    batch_size : int
+        Maximum rows deleted per transaction.
+
+    pause : float
+        Seconds to wait between batches.
+
+    Returns
+    -------
+    Dict reporting how much data was removed.
+    """
+    now = dt.now()
+    report = {
+        "partitions_dropped": [],
+        "partition_bytes_reclaimed": 0,
+        "samples_deleted": 0,
+        "rollups_deleted": 0,
+        "watering_events_deleted": 0
+    }
+
+    with engine.connect() as conn:
+        sensors = conn.execute(
+            select(sensor_table.c.id, sensor_table.c.type)).fetchall()
+    sensors_by_type = {}
+    for id, type in sensors:
+        sensors_by_type.setdefault(type, []).append(id)
+
+    raw_days = [sample_policy(policies, type).get("raw")
+                for type in sensors_by_type] or [None]
+    # Whole partitions can go once every sensor type's raw samples have expired.
+    if None not in raw_days:
+        cutoff = now - timedelta(days=max(raw_days))
+        with engine.connect() as conn:
+            expired = [name for name, lower, upper in sample_partitions(conn)
+                       if upper is not None and upper <= cutoff]
+            for name in expired:
+                report["partition_bytes_reclaimed"] += conn.execute(
+                    text("SELECT pg_total_relation_size(:name)"), {"name": name}
+                ).scalar()
+        report["partitions_dropped"] = detach_sample_partitions(
+            cutoff, drop=True)
+
+    for type, sensor_ids in sensors_by_type.items():
+        policy = sample_policy(policies, type)
+        if policy.get("raw") is not None:
+            report["samples_deleted"] += _delete_in_batches(
+                _delete_samples,
+                {"sensor_ids": sensor_ids,
+                 "cutoff": now - timedelta(days=policy["raw"])},
+                batch_size, pause)
+        for resolution in resolutions:
+            if policy.get(resolution) is not None:
+                report["rollups_deleted"] += _delete_in_batches(
+                    _delete_rollups,
+                    {"sensor_ids": sensor_ids, "resolution": resolution,
+                     "cutoff": now - timedelta(days=policy[resolution])},
+                    batch_size, pause)
+
+    if policies.get("watering_events") is not None:
+        report["watering_events_deleted"] = _delete_in_batches(
+            _delete_watering_events,
+            {"cutoff": now - timedelta(days=policies["watering_events"])},
+            batch_size, pause)
+
+    config_logger.info(f"Retention enforced: {report}")
+    return report
@@ -0,0 +1,167 @@
+"""Minute, hour and day aggregates of samples for zoomed out history graphs.
+
+Rollups are updated incrementally in the same transaction that inserts a
+batch of samples. Samples stored before rollups existed can be aggregated
+with the backfill command:
+
+    python -m utils.rollups backfill [start ISO date] [end ISO date]
+
+"""
+import sys
+from datetime import datetime as dt
+from datetime import timedelta
+
+from sqlalchemy import func, select, text
+from sqlalchemy.dialects.postgresql import insert
+
+from utils.db_interaction import engine, sample_rollup_table, sample_table
+from utils.logging import config_logger
+
+# Length in seconds of each rollup resolution, from finest to coarsest
+resolutions = {
+    "minute": 60,
+    "hour": 3600,
+    "day": 86400
+}
+
+
+def bucket_start(timestamp, resolution):
+    """Truncate a timestamp to the start of its bucket at the given resolution."""
+    if resolution == "minute":
+        return timestamp.replace(second=0, microsecond=0)
+    if resolution == "hour":
+        return timestamp.replace(minute=0, second=0, microsecond=0)
+    return timestamp.replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def aggregate(samples):
+    """Aggregate samples into rollup rows for every resolution.
+
+    Parameters
+    ----------
+    samples : list of dict
+        Samples with sensor_id, timestamp and value keys.
+
+    Returns
+    -------
+    List of rollup rows, one per sensor, resolution and bucket.
+    """
+    rollups = {}
+    for sample in samples:
+        for resolution in resolutions:
+            key = (int(sample["sensor_id"]), resolution,
+                   bucket_start(sample["timestamp"], resolution))
+            row = rollups.get(key)
+            if row is None:
+                rollups[key] = {
+                    "sensor_id": key[0],
+                    "resolution": key[1],
+                    "bucket": key[2],
+                    "min": sample["value"],
+                    "max": sample["value"],
+                    "sum": sample["value"],
+                    "count": 1
+                }
+            else:
+                row["min"] = min(row["min"], sample["value"])
+                row["max"] = max(row["max"], sample["value"])
+                row["sum"] += sample["value"]
+                row["count"] += 1
+    return list(rollups.values())
+
+
+def rollup_statement(rows):
+    """Build an upsert that merges rollup rows into the existing buckets."""
+    statement = insert(sample_rollup_table).values(rows)
+    table = sample_rollup_table.c
+    return statement.on_conflict_do_update(
+        index_elements=["sensor_id", "resolution", "bucket"],
+        set_={
+            "min": func.least(table.min, statement.excluded.min),
+            "max": func.greatest(table.max, statement.excluded.max),
+            "sum": table.sum + statement.excluded.sum,
+            "count": table.count + statement.excluded.count
+        }
+    )
+
+
+def choose_resolution(start, end, width):
+    """Return the coarsest resolution with at least one bucket per pixel.
+
+    Parameters
+    ----------
+    start, end : datetime
+        Time window being drawn.
+
+    width : int
+        Width of the graph in pixels.
+
+    Returns
+    -------
+    Name of a resolution, or None if only raw samples are fine enough.
+    """
+    window = (end - start).total_seconds()
+    for resolution, seconds in reversed(list(resolutions.items())):
+        if window / seconds >= width:
+            return resolution
+    return None
+
+
+def sample_source(resolution):
+    """Return the table, timestamp column and value column to read samples from.
+
+    Parameters
+    ----------
+    resolution : str
+        Name of a rollup resolution, or None for raw samples. The caller must
+        filter sample_rollup on the resolution column.
+    """
+    if resolution is None:
+        return sample_table, sample_table.c.timestamp, sample_table.c.value
+    return (
+        sample_rollup_table,
+        sample_rollup_table.c.bucket,
+        (sample_rollup_table.c.sum / sample_rollup_table.c.count).label("value")
+    )
+
+
+def backfill(start=None, end=None):
+    """Recompute rollups from the raw samples between start and end, one day at a time.
+
+    Buckets are replaced, not merged, so only backfill periods whose raw
+    samples have not been deleted.
+    """
+    with engine.connect() as conn:
+        first, last = conn.execute(
+            select(func.min(sample_table.c.timestamp),
+                   func.max(sample_table.c.timestamp))
+        ).first()
+    if first is None:
+        return
+    day = bucket_start(start or first, "day")
+    end = end or last + timedelta(seconds=1)
+
+    while day < end:
+        next_day = day + timedelta(days=1)
+        with engine.begin() as conn:
+            for resolution in resolutions:
+                conn.execute(text(
+                    "INSERT INTO sample_rollup "
+                    "(sensor_id, resolution, bucket, min, max, sum, count) "
+                    "SELECT sensor_id, :resolution, date_trunc(:resolution, timestamp), "
+                    "min(value), max(value), sum(value), count(*) "
+                    "FROM sample WHERE timestamp >= :start AND timestamp < :end "
+                    "GROUP BY sensor_id, date_trunc(:resolution, timestamp) "
+                    "ON CONFLICT (sensor_id, resolution, bucket) DO UPDATE SET "
+                    "min = excluded.min, max = excluded.max, "
+                    "sum = excluded.sum, count = excluded.count"
+                ), {"resolution": resolution, "start": day, "end": next_day})
+        config_logger.info(f"Backfilled rollups for {day.date()}")
+        day = next_day
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] != "backfill":
+        print("Usage: python -m utils.rollups backfill [start] [end]")
+        sys.exit(1)
+    backfill(*[dt.fromisoformat(arg) for arg in sys.argv[2:4]])
@@ -0,0 +1,101 @@
+"""Disk-backed spool for samples that could not be published.
+
+Samples are kept in a SQLite database in WAL mode, so they survive a restart
+of garden_monitor and can be replayed in order once the broker is reachable.
+"""
+import sqlite3
+
+from utils.logging import sample_logger
+from utils.payload_codecs import from_epoch_ms, to_epoch_ms
+
+
+class sample_spool():
+    """Ordered, size capped store of samples waiting to be published."""
+
+    def __init__(self, path="sample_spool.db", max_rows=100000):
+        """Open or create the spool.
+
+        Parameters
+        ----------
+        path : str
+            File of the SQLite database.
+
+        max_rows : int
+            Maximum number of spooled samples. The oldest samples are dropped
+            once the spool is full.
+        """
+        self.max_rows = max_rows
+        self.dropped = 0
+        self._full = False
+        self._conn = sqlite3.connect(path)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        # A power cut may lose the last transactions, but never corrupts the file.
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS spooled_sample ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, "
+            "sensor_id INTEGER NOT NULL, "
+            "timestamp INTEGER NOT NULL, "
+            "value REAL NOT NULL, "
+            "seq INTEGER)"
+        )
+        self._count = self._conn.execute(
+            "SELECT count(*) FROM spooled_sample").fetchone()[0]
+
+    def __len__(self):
+        """Return the number of spooled samples."""
+        return self._count
+
+    def add(self, sample):
+        """Spool a dict with sensor_id, value, datetime timestamp and optional seq keys."""
+        with self._conn:
+            self._conn.execute(
+                "INSERT INTO spooled_sample (sensor_id, timestamp, value, seq) "
+                "VALUES (?, ?, ?, ?)",
+                (int(sample["sensor_id"]), to_epoch_ms(sample["timestamp"]),
+                 sample["value"], sample.get("seq"))
+            )
+            self._count += 1
+            overflow = self._count - self.max_rows
+            if overflow > 0:
+                self._conn.execute(
+                    "DELETE FROM spooled_sample WHERE id IN ("
+                    "SELECT id FROM spooled_sample ORDER BY id LIMIT ?)", (overflow,))
+                self._count -= overflow
+                self.dropped += overflow
+        if overflow > 0 and not self._full:
+            self._full = True
+            sample_logger.warning(
+                f"Sample spool is full at {self.max_rows} samples, dropping the oldest")
+
+    def peek(self, limit):
+        """Return the ids and samples of up to limit of the oldest spooled samples.
+
+        Returns
+        -------
+        Tuple of the list of row ids and the list of sample dicts.
+        """
+        rows = self._conn.execute(
+            "SELECT id, sensor_id, timestamp, value, seq FROM spooled_sample "
+            "ORDER BY id LIMIT ?", (limit,)).fetchall()
+        samples = []
+        for id, sensor_id, timestamp, value, seq in rows:
+            sample = {"sensor_id": sensor_id,
+                      "timestamp": from_epoch_ms(timestamp), "value": value}
+            if seq is not None:
+                sample["seq"] = seq
+            samples.append(sample)
+        return [row[0] for row in rows], samples
+
+    def remove(self, ids):
+        """Remove samples returned by peek once they have been delivered."""
+        with self._conn:
+            removed = self._conn.executemany(
+                "DELETE FROM spooled_sample WHERE id = ?", [(id,) for id in ids]
+            ).rowcount
+        self._count -= removed
+        self._full = False
+
+    def close(self):
+        """Close the database file."""
+        self._conn.close()
@@ -0,0 +1,437 @@
+"""Buffered writers that batch samples into multi-row inserts."""
+import asyncio
+import threading
+import time
+
+from sqlalchemy import exc
+from sqlalchemy.dialects.postgresql import insert
+
+from utils.db_interaction import engine, sample_table
+from utils.logging import sample_logger
+from utils.rollups import aggregate, rollup_statement
+
+# Errors after which the same batch is likely to succeed later, such as a lost
+# connection, a statement timeout or an exhausted connection pool. Any other
+# error is blamed on the rows, and the batch is split to find them.
+transient_errors = (exc.OperationalError, exc.TimeoutError, exc.DisconnectionError)
+
+# Most samples written per transaction. The rollup upsert binds up to 21
+# parameters per sample, and asyncpg refuses statements with more than 32767.
+max_statement_rows = 1000
+
+
+def is_transient(error):
+    """Return whether a failed write is likely to succeed if retried unchanged.
+
+    An InterfaceError only counts when it invalidated the connection, since
+    asyncpg also raises it for statements it refuses, such as one with too
+    many bind parameters.
+    """
+    return isinstance(error, transient_errors) or getattr(error, "connection_invalidated", False)
+
+
+class _flush_counters():
+    """Buffer, retry backoff and flush counters shared by the sample writers."""
+
+    def __init__(self, max_buffered=100000, min_backoff=0.5, max_backoff=30.0):
+        """Zero all of the counters.
+
+        Parameters
+        ----------
+        max_buffered : int
+            Maximum samples held while the database is unreachable, the oldest
+            are dropped beyond it.
+
+        min_backoff, max_backoff : float
+            Seconds before retrying after the first failed flush, doubled
+            after every further failure up to max_backoff.
+        """
+        self._buffer = []
+        self.max_buffered = max_buffered
+        self.min_backoff = min_backoff
+        self.max_backoff = max_backoff
+        self._backoff = 0.0
+        self._retry_at = 0.0
+        # Counters are updated from the flush thread and the threads writing batches.
+        self._stats_lock = threading.Lock()
+        self.batches_flushed = 0
+        self.samples_flushed = 0
+        self.last_batch_size = 0
+        self.max_batch_size = 0
+        self.last_flush_seconds = 0.0
+        self.max_flush_seconds = 0.0
+        self.total_flush_seconds = 0.0
+        self.failed_flushes = 0
+        self.retried_samples = 0
+        self.rejected_samples = 0
+        self.overflowed_samples = 0
+
+    def stats(self):
+        """Return the writer's counters as a dict."""
+        with self._stats_lock:
+            return self._stats()
+
+    def _stats(self):
+        """Build the stats dict, the stats lock must be held."""
+        return {
+            "buffered": len(self._buffer),
+            "batches_flushed": self.batches_flushed,
+            "samples_flushed": self.samples_flushed,
+            "last_batch_size": self.last_batch_size,
+            "max_batch_size": self.max_batch_size,
+            "mean_batch_size": self.samples_flushed / self.batches_flushed if self.batches_flushed else 0,
+            "last_flush_seconds": self.last_flush_seconds,
+            "max_flush_seconds": self.max_flush_seconds,
+            "mean_flush_seconds": self.total_flush_seconds / self.batches_flushed if self.batches_flushed else 0,
+            "failed_flushes": self.failed_flushes,
+            "retried_samples": self.retried_samples,
+            "rejected_samples": self.rejected_samples,
+            "overflowed_samples": self.overflowed_samples
+        }
+
+    def _record_flush(self, batch, elapsed):
+        """Update the counters after a successful flush."""
+        with self._stats_lock:
+            self.batches_flushed += 1
+            self.samples_flushed += len(batch)
+            self.last_batch_size = len(batch)
+            self.max_batch_size = max(self.max_batch_size, len(batch))
+            self.last_flush_seconds = elapsed
+            self.max_flush_seconds = max(self.max_flush_seconds, elapsed)
+            self.total_flush_seconds += elapsed
+            self._backoff = 0.0
+        sample_logger.debug(
+            f"Flushed {len(batch)} samples in {elapsed * 1000:.1f} ms")
+
+    def _record_transient(self, batch, error):
+        """Count a batch that will be retried and push back the next flush."""
+        with self._stats_lock:
+            self.failed_flushes += 1
+            self.retried_samples += len(batch)
+            self._backoff = min(max(self._backoff * 2, self.min_backoff), self.max_backoff)
+            self._retry_at = time.monotonic() + self._backoff
+            backoff = self._backoff
+        sample_logger.warning(
+            f"Failed to flush {len(batch)} samples, retrying in {backoff:.1f} s: {error}")
+
+    def _record_rejected(self, sample, error):
+        """Count and log a sample the database refused, e.g. one for an unknown sensor."""
+        with self._stats_lock:
+            self.failed_flushes += 1
+            self.rejected_samples += 1
+        sample_logger.error(f"Dropped sample {sample}: {error}")
+
+    def _chunk_size(self):
+        """Return the number of samples written per transaction."""
+        return max(min(self.batch_size, max_statement_rows), 1)
+
+    def _prepend(self, samples):
+        """Put samples back at the front of the buffer, the buffer's lock must be held.
+
+        Returns
+        -------
+        Number of the oldest samples dropped to stay within max_buffered.
+        """
+        self._buffer[:0] = samples
+        overflow = max(len(self._buffer) - self.max_buffered, 0)
+        if overflow:
+            del self._buffer[:overflow]
+            with self._stats_lock:
+                self.overflowed_samples += overflow
+            sample_logger.error(
+                f"Sample buffer full, dropped the {overflow} oldest samples")
+        return overflow
+
+
+class sample_writer(_flush_counters):
+    """Collect samples in memory and flush them to the database in batches.
+
+    A batch is flushed when it reaches batch_size samples or when the oldest
+    buffered sample has waited max_latency seconds, whichever happens first.
+    After a transient database error the batch goes back to the front of the
+    buffer and is retried with exponential backoff. After any other error the
+    batch is split in halves until only the rows the database refuses are
+    dropped.
+    """
+
+    def __init__(self, batch_size=100, max_latency=1.0, **retry_settings):
+        """Create a new sample writer and start its flush thread.
+
+        Parameters
+        ----------
+        batch_size : int
+            Number of buffered samples that triggers an immediate flush.
+
+        max_latency : float
+            Maximum number of seconds a sample may wait in the buffer.
+
+        retry_settings
+            max_buffered, min_backoff and max_backoff, see _flush_counters.
+        """
+        super().__init__(**retry_settings)
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+
+        self._oldest = None
+        self._condition = threading.Condition()
+        self._flush_lock = threading.Lock()
+        self._stopped = False
+
+        self._thread = threading.Thread(
+            target=self._run, name="sample_writer", daemon=True)
+        self._thread.start()
+
+    def add(self, data):
+        """Buffer a single sample to be written on the next flush.
+
+        Parameters
+        ----------
+        data : dict
+            Sample with sensor_id, timestamp and value keys.
+        """
+        with self._condition:
+            if self._stopped:
+                raise RuntimeError("sample_writer has been stopped")
+            if not self._buffer:
+                self._oldest = time.monotonic()
+            self._buffer.append(data)
+            if len(self._buffer) > self.max_buffered:
+                self._buffer.pop(0)
+                with self._stats_lock:
+                    self.overflowed_samples += 1
+            if len(self._buffer) >= self.batch_size:
+                self._condition.notify()
+
+    def flush(self):
+        """Write every buffered sample to the database, batch_size samples per transaction.
+
+        After a transient error the failed samples and every sample after them
+        are put back in the buffer.
+        """
+        with self._flush_lock:
+            with self._condition:
+                batch, self._buffer = self._buffer, []
+                self._oldest = None
+            self._retry(self._write_chunks(batch))
+
+    def write_batch(self, batch):
+        """Write a batch of samples immediately, bypassing the buffer.
+
+        If the database is unreachable, the batch joins the buffer to be retried.
+        """
+        self._retry(self._write_chunks(batch))
+
+    def stop(self):
+        """Stop the flush thread and write out anything still buffered."""
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        self._thread.join()
+        self.flush()
+        if self._buffer:
+            sample_logger.error(
+                f"Lost {len(self._buffer)} buffered samples, the database is unreachable")
+
+    def _retry(self, samples):
+        """Buffer samples to be written again once the retry backoff has passed."""
+        if not samples:
+            return
+        with self._condition:
+            self._prepend(samples)
+            if self._oldest is None:
+                self._oldest = time.monotonic()
+            self._condition.notify()
+
+    def _run(self):
+        """Flush the buffer whenever it is full or has waited too long."""
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    # Wait out the backoff after a failed flush.
+                    backoff = self._retry_at - time.monotonic()
+                    if backoff > 0:
+                        self._condition.wait(backoff)
+                        continue
+                    if len(self._buffer) >= self.batch_size:
+                        break
+                    if self._oldest is not None:
+                        remaining = self._oldest + self.max_latency - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self._condition.wait(remaining)
+                    else:
+                        self._condition.wait()
+                if self._stopped:
+                    return
+            try:
+                self.flush()
+            except Exception as error:
+                # Keep the thread alive.
+                sample_logger.exception(f"Failed to flush samples: {error}")
+
+    def _write_chunks(self, batch):
+        """Write a batch one chunk per transaction, stopping at a transient error.
+
+        Returns
+        -------
+        List of the samples to retry, from the first failed chunk on.
+        """
+        size = self._chunk_size()
+        for start in range(0, len(batch), size):
+            retry = self._write(batch[start:start + size])
+            if retry:
+                return retry + batch[start + size:]
+        return []
+
+    def _write(self, batch):
+        """Insert a batch of samples and update their rollups in one transaction.
+
+        Returns
+        -------
+        List of the samples to retry after a transient error.
+        """
+        start = time.monotonic()
+        try:
+            with engine.connect() as conn:
+                conn.execute(insert(sample_table).values(batch))
+                conn.execute(rollup_statement(aggregate(batch)))
+                conn.commit()
+        except exc.SQLAlchemyError as error:
+            if is_transient(error):
+                self._record_transient(batch, error)
+                return batch
+            if len(batch) == 1:
+                self._record_rejected(batch[0], error)
+                return []
+            middle = len(batch) // 2
+            return self._write(batch[:middle]) + self._write(batch[middle:])
+        self._record_flush(batch, time.monotonic() - start)
+        return []
+
+
+class async_sample_writer(_flush_counters):
+    """asyncio version of sample_writer that writes through an async engine."""
+
+    def __init__(self, async_engine, batch_size=100, max_latency=1.0, **retry_settings):
+        """Create a new async sample writer.
+
+        Parameters
+        ----------
+        async_engine : sqlalchemy.ext.asyncio.AsyncEngine
+            Engine to write the samples with.
+
+        batch_size : int
+            Number of buffered samples that triggers an immediate flush.
+
+        max_latency : float
+            Maximum number of seconds a sample may wait in the buffer.
+
+        retry_settings
+            max_buffered, min_backoff and max_backoff, see _flush_counters.
+        """
+        super().__init__(**retry_settings)
+        self.async_engine = async_engine
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self._flush_lock = asyncio.Lock()
+        self._full = asyncio.Event()
+        self._task = None
+
+    def start(self):
+        """Start the background flush task on the running event loop."""
+        self._task = asyncio.create_task(self._run())
+
+    def add(self, data):
+        """Buffer a single sample to be written on the next flush."""
+        self._buffer.append(data)
+        if len(self._buffer) > self.max_buffered:
+            self._buffer.pop(0)
+            with self._stats_lock:
+                self.overflowed_samples += 1
+        if len(self._buffer) >= self.batch_size:
+            self._full.set()
+
+    async def flush(self):
+        """Write every buffered sample to the database, batch_size samples per transaction.
+
+        After a transient error the failed samples and every sample after them
+        are put back in the buffer.
+        """
+        async with self._flush_lock:
+            batch, self._buffer = self._buffer, []
+            self._full.clear()
+            self._prepend(await self._write_chunks(batch))
+
+    async def write_batch(self, batch):
+        """Write a batch of samples immediately, bypassing the buffer.
+
+        If the database is unreachable, the batch joins the buffer to be retried.
+        """
+        self._prepend(await self._write_chunks(batch))
+
+    async def _write_chunks(self, batch):
+        """Write a batch one chunk per transaction, stopping at a transient error.
+
+        Returns
+        -------
+        List of the samples to retry, from the first failed chunk on.
+        """
+        size = self._chunk_size()
+        for start in range(0, len(batch), size):
+            retry = await self._write(batch[start:start + size])
+            if retry:
+                return retry + batch[start + size:]
+        return []
+
+    async def _write(self, batch):
+        """Insert a batch of samples and update their rollups in one transaction.
+
+        Returns
+        -------
+        List of the samples to retry after a transient error.
+        """
+        start = time.monotonic()
+        try:
+            async with self.async_engine.begin() as conn:
+                await conn.execute(insert(sample_table).values(batch))
+                await conn.execute(rollup_statement(aggregate(batch)))
+        except exc.SQLAlchemyError as error:
+            if is_transient(error):
+                self._record_transient(batch, error)
+                return batch
+            if len(batch) == 1:
+                self._record_rejected(batch[0], error)
+                return []
+            middle = len(batch) // 2
+            return await self._write(batch[:middle]) + await self._write(batch[middle:])
+        self._record_flush(batch, time.monotonic() - start)
+        return []
+
+    async def stop(self):
+        """Cancel the flush task and write out anything still buffered."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
+        if self._buffer:
+            sample_logger.error(
+                f"Lost {len(self._buffer)} buffered samples, the database is unreachable")
+
+    async def _run(self):
+        """Flush the buffer whenever it is full or max_latency has passed."""
+        while True:
+            # Wait out the backoff after a failed flush.
+            backoff = self._retry_at - time.monotonic()
+            if backoff > 0:
+                await asyncio.sleep(backoff)
+            try:
+                await asyncio.wait_for(self._full.wait(), self.max_latency)
+            except asyncio.TimeoutError:
+                pass
+            try:
+                await self.flush()
+            except Exception as error:
+                sample_logger.exception(f"Failed to flush samples: {error}")
@@ -0,0 +1,103 @@
+"""Deadline scheduler for sampling sensors at their sample_gap."""
+import heapq
+import math
+import time
+
+
+class sampling_scheduler():
+    """Priority queue of the next due time of every group of sensors.
+
+    Sensors that share a gap are read together on the same tick. Adaptive
+    sensors move between groups as their gap changes.
+    Deadlines advance by whole gaps on a monotonic clock, so wall clock changes
+    do not disturb sampling and slow ticks do not make the schedule drift.
+    """
+
+    def __init__(self):
+        """Create a scheduler with nothing to sample."""
+        self._heap = []
+        self._groups = {}
+        self.ticks = 0
+        self.skipped_ticks = 0
+        self.last_jitter = 0.0
+        self.max_jitter = 0.0
+        self.total_jitter = 0.0
+        self._cpu_start = time.process_time()
+        self._wall_start = time.monotonic()
+
+    def schedule(self, sensors):
+        """Replace the schedule with the given sensors.
+
+        Parameters
+        ----------
+        sensors : dict
+            Sensor objects with a gap by sensor_id. Every group is first due
+            one gap from now.
+        """
+        now = time.monotonic()
+        self._groups = {}
+        for id, sensor in sensors.items():
+            self._groups.setdefault(sensor.gap, []).append(id)
+        self._heap = [(now + gap, gap) for gap in self._groups]
+        heapq.heapify(self._heap)
+
+    def reschedule(self, sensor_id, gap):
+        """Move a sensor to the group of another gap.
+
+        The sensor joins the next tick of an existing group, or a new group
+        first due one gap from now.
+        """
+        for group_gap, ids in list(self._groups.items()):
+            if sensor_id in ids:
+                ids.remove(sensor_id)
+            if not ids:
+                # The group's heap entry is dropped when it comes due.
+                del self._groups[group_gap]
+        self._groups.setdefault(gap, []).append(sensor_id)
+        if gap not in [group_gap for deadline, group_gap in self._heap]:
+            heapq.heappush(self._heap, (time.monotonic() + gap, gap))
+
+    def due(self):
+        """Return the ids of every sensor whose deadline has passed and schedule their next tick."""
+        now = time.monotonic()
+        ids = []
+        while self._heap and self._heap[0][0] <= now:
+            deadline, gap = heapq.heappop(self._heap)
+            if gap not in self._groups:
+                continue
+            self._record_jitter(now - deadline)
+            ids.extend(self._groups[gap])
+            # Ticks that were missed entirely are skipped rather than run back to back.
+            missed = math.floor((now - deadline) / gap)
+            self.skipped_ticks += missed
+            heapq.heappush(self._heap, (deadline + (missed + 1) * gap, gap))
+        return ids
+
+    def time_until_next(self):
+        """Return the seconds until the next deadline, None if nothing is scheduled."""
+        if not self._heap:
+            return None
+        return max(self._heap[0][0] - time.monotonic(), 0.0)
+
+    def _record_jitter(self, lateness):
+        """Update the jitter counters with how late a tick started."""
+        self.ticks += 1
+        self.last_jitter = lateness
+        self.max_jitter = max(self.max_jitter, lateness)
+        self.total_jitter += lateness
+
+    def stats(self):
+        """Return the scheduler's counters and the CPU use since the last call as a dict."""
+        cpu, wall = time.process_time(), time.monotonic()
+        cpu_percent = (cpu - self._cpu_start) / (wall - self._wall_start) * 100 \
+            if wall > self._wall_start else 0.0
+        self._cpu_start, self._wall_start = cpu, wall
+        return {
+            "groups": {str(gap): len(ids) for gap, ids in self._groups.items()},
+            "ticks": self.ticks,
+            "skipped_ticks": self.skipped_ticks,
+            "last_jitter_ms": round(self.last_jitter * 1000, 2),
+            "max_jitter_ms": round(self.max_jitter * 1000, 2),
+            "mean_jitter_ms": round(self.total_jitter / self.ticks * 1000, 2) if self.ticks else 0,
+            "cpu_percent": round(cpu_percent, 2)
+        }
@@ -1,9 +1,13 @@
 """Utility class that standarizes interaction with different sensors."""
+import threading
 import time
 from datetime import datetime as dt
 
 import adafruit_dht
 
+from utils.calibration import two_point
+from utils.logging import sample_logger
+
 
 class generic_sensor():
     """Abstrac class that describes expected behavior of a sensor."""
@@ -14,16 +18,125 @@ class generic_sensor():
         self.unit = unit
         self.sample_gap = sample_gap
         self.last_sample = dt.now()
+        self.deadband = None
+        self.heartbeat = None
+        self.last_published = None
+        self.last_published_at = None
+        # Seconds until the next reading, only differs from sample_gap in adaptive mode.
+        self.gap = sample_gap
+        self.min_gap = None
+        self.max_gap = None
+        self.rate_threshold = 1.0
+        self.boost_until = 0.0
+        # Smallest change a reading can resolve, changes within it are noise.
+        self.resolution = 0.0
+        self.previous_value = None
+        self.previous_at = None
 
     def sample(self):
         """Return a sample of data."""
         raise NotImplementedError
 
+    def set_reporting(self, deadband=None, heartbeat=None):
+        """Publish only changes larger than deadband, and at least every heartbeat seconds.
+
+        Parameters
+        ----------
+        deadband : float
+            Smallest change from the last published value worth publishing,
+            None to publish every reading.
+
+        heartbeat : int
+            Maximum number of seconds between published readings, None for no limit.
+        """
+        self.deadband = deadband
+        self.heartbeat = heartbeat
+
+    def set_adaptive(self, min_gap=None, max_gap=None, rate_threshold=None):
+        """Adapt the gap between readings to how fast they change, within min_gap and max_gap.
+
+        Parameters
+        ----------
+        min_gap, max_gap : int
+            Shortest and longest gap in seconds, None for a fixed sample_gap.
+
+        rate_threshold : float
+            Change per minute, in the sensor's unit, above which readings are
+            taken every min_gap. Readings changing at less than a quarter of it
+            are flat and double the gap. Changes no larger than the deadband or
+            the sensor's resolution are noise and count as flat.
+        """
+        self.min_gap = min_gap
+        self.max_gap = max_gap
+        if rate_threshold is not None:
+            self.rate_threshold = rate_threshold
+        self.gap = min(max(self.sample_gap, min_gap), max_gap) if self.adaptive \
+            else self.sample_gap
+
+    @property
+    def adaptive(self):
+        """Return whether the gap between readings adapts to the readings."""
+        return self.min_gap is not None and self.max_gap is not None
+
+    def adapt(self, value):
+        """Update the gap from the rate of change of a new reading and return it.
+
+        Changes no larger than the deadband or the sensor's resolution are
+        noise and count as no change, so ADC noise does not hold the gap at
+        min_gap.
+        """
+        now = time.monotonic()
+        rate = None
+        if self.previous_value is not None and now > self.previous_at:
+            change = abs(value - self.previous_value)
+            if change <= max(self.deadband or 0.0, self.resolution):
+                change = 0.0
+            rate = change / (now - self.previous_at) * 60
+        self.previous_value, self.previous_at = value, now
+        if not self.adaptive:
+            return self.gap
+        if now < self.boost_until or (rate is not None and rate > self.rate_threshold):
+            self.gap = self.min_gap
+        elif rate is not None and rate < self.rate_threshold / 4:
+            self.gap = min(self.gap * 2, self.max_gap)
+        return self.gap
+
+    def boost(self, seconds):
+        """Take readings every min_gap for the next seconds, e.g. while a watering soaks in.
+
+        Returns
+        -------
+        The new gap.
+        """
+        if self.adaptive:
+            self.boost_until = time.monotonic() + seconds
+            self.gap = self.min_gap
+        return self.gap
+
+    def should_publish(self, value):
+        """Return whether a reading should be published, recording it as published if so.
+
+        Between published readings the value stays within the deadband, so the
+        series can be reconstructed as steps that hold the last published value.
+        """
+        now = time.monotonic()
+        publish = (
+            not self.deadband
+            or self.last_published is None
+            or abs(value - self.last_published) > self.deadband
+            or (self.heartbeat is not None and now - self.last_published_at >= self.heartbeat)
+        )
+        if publish:
+            self.last_published = value
+            self.last_published_at = now
+        return publish
+
 
 class soil_humidity(generic_sensor):
     """A single capacitive soil humidity sensor hooked to an ADC."""
 
-    def __init__(self, id, adc, adc_index, unit="", sample_gap=60, wet_value=0, dry_value=255):
+    def __init__(self, id, adc, adc_index, unit="", sample_gap=60, wet_value=0, dry_value=255,
+                 oversample=8, filter="median", calibration=None):
         """Concrete soil humidity sensor.
 
         Capacitive soil humidity sensor that emits an anologue reading.
@@ -53,36 +166,54 @@ class soil_humidity(generic_sensor):
         wet_value : int
             This should be the value from the adc that represents
                 completely saturated soil.
+
+        calibration : utils.calibration.calibration
+            Curve from ADC readings to percent humidity, a straight line from
+            wet_value to dry_value when None.
+
+        oversample : int
+            Number of conversions of the channel per reading.
+
+        filter : str
+            Name of the filter in adc_library.filters that combines the conversions.
         """
         super().__init__(id, unit, sample_gap)
         self.adc = adc
         self.adc_index = adc_index
         self.dry_value = dry_value
         self.wet_value = wet_value
+        self.oversample = oversample
+        self.filter = filter
+        self.calibration = calibration or two_point(wet_value, 100, dry_value, 0)
+        self.resolution = self.calibration.step
 
     def sample(self):
         """Collect a sample from this sensor.
 
+        Returns
+        -------
+        Percent from 0-1 indicating the percentage humidity measured in the soil.
+        """
+        return self.convert(scan_adc([self])[self.adc_index])
+
+    def convert(self, raw_reading):
+        """Convert a filtered reading of this sensor's ADC channel.
+
         Moist readings are lower than dry readings.
 
         Returns
         -------
         Percent from 0-1 indicating the percentage humidity measured in the soil.
         """
-        raw_reading = self.adc.analogRead(self.adc_index)
         self.last_sample = dt.now()
-        result = (1 - (raw_reading - self.wet_value) /
-                  (self.dry_value - self.wet_value)) * 100
-        result = min(result, 100)
-        result = max(result, 0)
-        result = round(result, 2)
-        return result
+        return self.calibration.convert(raw_reading)
 
 
 class light(generic_sensor):
     """A photoresistor light sensor."""
 
-    def __init__(self, id, adc, adc_index, unit="", sample_gap=60, dark_value=0, light_value=255):
+    def __init__(self, id, adc, adc_index, unit="", sample_gap=60, dark_value=0, light_value=255,
+                 oversample=8, filter="median", calibration=None):
         """Create a new photoresistor light sensor.
 
         The photoresistor emits an anolog signal that's read by the adc.
@@ -109,83 +240,153 @@ class light(generic_sensor):
 
         light_value : int
             This should be the value in a very bright setting
+
+        calibration : utils.calibration.calibration
+            Curve from ADC readings to percent light, a straight line from
+            dark_value to light_value when None.
+
+        oversample : int
+            Number of conversions of the channel per reading.
+
+        filter : str
+            Name of the filter in adc_library.filters that combines the conversions.
         """
         super().__init__(id, unit, sample_gap)
         self.adc = adc
         self.adc_index = adc_index
         self.dark_value = dark_value
         self.light_value = light_value
+        self.oversample = oversample
+        self.filter = filter
+        self.calibration = calibration or two_point(dark_value, 0, light_value, 100)
+        self.resolution = self.calibration.step
 
     def sample(self):
         """Collect a sample from this sensor.
 
+        Returns
+        -------
+        Percent from 0-1 indicating the percentage of light.
+        """
+        return self.convert(scan_adc([self])[self.adc_index])
+
+    def convert(self, raw_reading):
+        """Convert a filtered reading of this sensor's ADC channel.
+
         light readings are higher than dark readings.
 
         Returns
         -------
         Percent from 0-1 indicating the percentage of light.
         """
-        raw_reading = self.adc.analogRead(self.adc_index)
         self.last_sample = dt.now()
-        result = (raw_reading - self.dark_value) / \
-            (self.light_value - self.dark_value) * 100
-        result = min(result, 100)
-        result = max(result, 0)
-        result = round(result, 2)
-        return result
+        return self.calibration.convert(raw_reading)
+
+
+def scan_adc(adc_sensors):
+    """Read the channels of several ADC sensors in one pass of their ADC.
+
+    Parameters
+    ----------
+    adc_sensors : list
+        soil_humidity and light sensors sharing one ADC. A channel read by
+        several sensors uses the oversampling and filter of the first.
+
+    Returns
+    -------
+    Dict of the filtered raw reading of each adc_index.
+    """
+    if not adc_sensors:
+        return {}
+    channels = {}
+    for sensor in adc_sensors:
+        channels.setdefault(sensor.adc_index, (sensor.oversample, sensor.filter))
+    return adc_sensors[0].adc.scan(channels)
 
 
 class dht_22():
-    """Wrapper for the DHT-22 to prevent over-querying."""
+    """Poll a DHT-22 on a background thread and cache its latest reading.
 
-    def __init__(self, pin):
-        """Create one instance of this class per DHT-22.
+    The reading is replaced as a whole tuple, so readers never see the
+    temperature of one poll with the humidity of another and need no lock.
+    """
+
+    def __init__(self, pin, interval=2.0, max_age=30.0):
+        """Create one instance of this class per DHT-22 and start polling it.
 
         Parameters
         ----------
         pin : board.pin
             The GPIO pin that the DHT-22's data wire is connected to.
-        """
-        self.dhtDevice = adafruit_dht.DHT22(pin, use_pulseio=False)
-        self.temperature_f = 0
-        self.humidity = 0
-        self._update_values()
 
-    def get_humidity(self):
-        """Return the current relative humidity.
+        interval : float
+            Seconds between polls, the DHT-22 cannot be read more than once every 2 seconds.
 
-        Returns the most recent humidity value or querries the sensor again if more than 2 seconds have passed
+        max_age : float
+            Seconds after which the latest reading is stale and no longer reported.
         """
-        if ((dt.now() - self.last_sample).total_seconds() > 2.5):
-            self._update_values()
+        self.dhtDevice = adafruit_dht.DHT22(pin, use_pulseio=False)
+        self.interval = max(interval, 2.0)
+        self.max_age = max_age
+        # (temperature_f, humidity, monotonic time of the reading, valid)
+        self.reading = (0, 0, None, False)
+        self.failed_polls = 0
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name="dht_22", daemon=True)
+        self._thread.start()
+
+    def latest(self):
+        """Return the latest (temperature_f, humidity, time, valid) reading, None if it is stale."""
+        reading = self.reading
+        temperature_f, humidity, read_at, valid = reading
+        if not valid or time.monotonic() - read_at > self.max_age:
+            return None
+        return reading
 
-        return round(self.humidity, 1)
+    def get_humidity(self):
+        """Return the latest relative humidity, None if there is no fresh reading."""
+        reading = self.latest()
+        return None if reading is None else round(reading[1], 1)
 
     def get_temperature_f(self):
-        """Return the current temperature in fahrenheit.
-
-        Returns the most recent temperature value or querries the sensor again if more than 2 seconds have passed
-        """
-        if (not self.last_sample or (dt.now() - self.last_sample).total_seconds() > 2.5):
+        """Return the latest temperature in fahrenheit, None if there is no fresh reading."""
+        reading = self.latest()
+        return None if reading is None else round(reading[0], 1)
+
+    def stop(self):
+        """Stop polling and release the sensor."""
+        self._stopped.set()
+        self._thread.join()
+        self.dhtDevice.exit()
+
+    def _run(self):
+        """Poll the sensor every interval seconds until stopped."""
+        while True:
             self._update_values()
-        return round(self.temperature_f, 1)
+            if self._stopped.wait(self.interval):
+                return
 
     def _update_values(self):
-        """Private method to retrieve values then put them in cache to rate-limit querries."""
+        """Read the sensor and replace the cached reading if the read succeeds."""
         try:
-            self.last_sample = dt.now()
             temperature_c = self.dhtDevice.temperature
-            self.temperature_f = temperature_c * (9 / 5) + 32
-            self.humidity = self.dhtDevice.humidity
-
+            humidity = self.dhtDevice.humidity
         except RuntimeError as error:
             # Errors happen fairly often, DHT's are hard to read, just keep going
-            print(error.args[0])
-            time.sleep(2.0)
-
+            self.failed_polls += 1
+            sample_logger.debug(f"DHT-22 read failed: {error.args[0]}")
+            return
         except Exception as error:
+            sample_logger.error(f"DHT-22 stopped polling: {error}")
+            self.reading = self.reading[:3] + (False,)
+            self._stopped.set()
             self.dhtDevice.exit()
-            raise error
+            return
+        if temperature_c is None or humidity is None:
+            self.failed_polls += 1
+            return
+        self.reading = (temperature_c * (9 / 5) + 32, humidity, time.monotonic(), True)
 
 
 class ambient_temperature(generic_sensor):
@@ -219,7 +420,7 @@ class ambient_temperature(generic_sensor):
 
         Returns
         -------
-        Temperature in fahrenheit
+        Temperature in fahrenheit, None if the DHT-22 has no fresh reading.
         """
         self.last_sample = dt.now()
         return self.dht_22.get_temperature_f()
@@ -256,7 +457,7 @@ class ambient_humidity(generic_sensor):
 
         Returns
         -------
-        Relative humidity percentage.
+        Relative humidity percentage, None if the DHT-22 has no fresh reading.
         """
         self.last_sample = dt.now()
         return self.dht_22.get_humidity()
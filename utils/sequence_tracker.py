@@ -0,0 +1,106 @@
+"""Duplicate and gap detection from the per-sensor sequence numbers of samples.
+
+A sequence number carries the sender's session, the Unix time it started, in
+the bits above session_bits and a per-sensor counter from 1 below them, so
+numbers keep increasing across restarts of garden_monitor.
+"""
+import threading
+import time
+
+# Number of low bits of a sequence number that hold the per-session counter
+session_bits = 32
+
+
+def first_sequence():
+    """Return the sequence number before the first sample of a new session."""
+    return int(time.time()) << session_bits
+
+
+class sequence_tracker():
+    """Track the sequence numbers seen from each sensor.
+
+    A number seen before is a duplicate redelivery, a jump counts the skipped
+    numbers as missing and a number from a newer session means the sender
+    restarted.
+    """
+
+    def __init__(self, window=256):
+        """Create an empty tracker.
+
+        Parameters
+        ----------
+        window : int
+            Number of recent sequence numbers remembered per sensor to
+            recognise duplicates and late deliveries.
+        """
+        self.window = window
+        self._lock = threading.Lock()
+        # sensor_id -> (latest sequence number, recently seen sequence numbers)
+        self._sensors = {}
+        self.accepted = 0
+        self.duplicates = 0
+        self.missing = 0
+        self.late = 0
+        self.restarts = 0
+        self.missing_by_sensor = {}
+
+    def check(self, sensor_id, seq):
+        """Record a sample's sequence number and return whether it should be stored.
+
+        Parameters
+        ----------
+        sensor_id : int
+            ID of the sensor the sample came from.
+
+        seq : int
+            Sequence number of the sample, or None for senders without one.
+
+        Returns
+        -------
+        False if the sample is a duplicate, True otherwise.
+        """
+        if seq is None:
+            return True
+        with self._lock:
+            self.accepted += 1
+            state = self._sensors.get(sensor_id)
+            if state is None or seq >> session_bits > state[0] >> session_bits:
+                if state is not None:
+                    self.restarts += 1
+                self._sensors[sensor_id] = (seq, {seq})
+                return True
+
+            last, seen = state
+            if seq in seen:
+                self.accepted -= 1
+                self.duplicates += 1
+                return False
+            if seq > last:
+                skipped = seq - last - 1
+                if skipped:
+                    self.missing += skipped
+                    self.missing_by_sensor[sensor_id] = \
+                        self.missing_by_sensor.get(sensor_id, 0) + skipped
+                seen = {number for number in seen if number > seq - self.window}
+                self._sensors[sensor_id] = (seq, seen)
+            else:
+                # A late delivery fills a gap that was already counted.
+                self.late += 1
+                if self.missing_by_sensor.get(sensor_id, 0) > 0:
+                    self.missing -= 1
+                    self.missing_by_sensor[sensor_id] -= 1
+            seen.add(seq)
+            return True
+
+    def stats(self):
+        """Return the tracker's counters as a dict."""
+        with self._lock:
+            return {
+                "accepted": self.accepted,
+                "duplicates": self.duplicates,
+                "missing": self.missing,
+                "late": self.late,
+                "restarts": self.restarts,
+                "missing_by_sensor": {
+                    str(id): count for id, count in self.missing_by_sensor.items() if count}
+            }
@@ -0,0 +1,105 @@
+"""Watering rules that garden_monitor evaluates locally after each sample.
+
+garden_manager compiles the rules from the plant table and publishes them
+retained on plants/rules. The monitor keeps the latest rules and the last
+watering time of every plant in a JSON file, so it keeps watering with the
+last known rules while the broker or manager is unreachable.
+"""
+import json
+import os
+import threading
+from datetime import datetime as dt
+
+
+class watering_rules():
+    """Plant rules by soil humidity sensor_id and the last watering time per plant."""
+
+    def __init__(self, path="watering_rules.json"):
+        """Load the rules saved by a previous run, if any.
+
+        Parameters
+        ----------
+        path : str
+            JSON file the rules and watering times are saved to.
+        """
+        self.path = path
+        # Pump events record watering times from the pump scheduler's thread.
+        self._lock = threading.Lock()
+        self.enabled = False
+        self.rules = {}
+        self.last_watered = {}
+        if os.path.exists(path):
+            with open(path, "r") as rules_file:
+                saved = json.load(rules_file)
+            self.enabled = saved.get("enabled", False)
+            self.rules = saved.get("rules", {})
+            self.last_watered = {
+                plant_id: dt.fromisoformat(timestamp)
+                for plant_id, timestamp in saved.get("last_watered", {}).items()}
+
+    def update(self, payload):
+        """Replace the rules with a plants/rules payload and save them.
+
+        Payload format:
+            {
+                enabled: <bool>,
+                rules: {<sensor_id>: {plant_id, pump_id, target, tolerance, cooldown, duration}}
+            }
+        """
+        self.enabled = payload.get("enabled", True)
+        self.rules = payload.get("rules", {})
+        self.save()
+
+    def sensor_for_pump(self, pump_id):
+        """Return the soil humidity sensor_id of the plant watered by a pump, or None."""
+        for sensor_id, rule in self.rules.items():
+            if rule["pump_id"] == str(pump_id):
+                return sensor_id
+        return None
+
+    def rule_for_pump(self, pump_id):
+        """Return the rule of the plant watered by a pump, or None."""
+        return self.rules.get(self.sensor_for_pump(pump_id))
+
+    def record(self, plant_id, timestamp):
+        """Record that a plant was watered and save it."""
+        plant_id = str(plant_id)
+        with self._lock:
+            last = self.last_watered.get(plant_id)
+            if last is not None and timestamp <= last:
+                return
+            self.last_watered[plant_id] = timestamp
+        self.save()
+
+    def evaluate(self, sensor_id, value, timestamp):
+        """Return the rule to water by if a soil humidity sample calls for watering.
+
+        The plant is watered when the value is below target - tolerance and
+        more than cooldown seconds have passed since it was last watered.
+
+        Returns
+        -------
+        The plant's rule, or None if no watering is needed.
+        """
+        rule = self.rules.get(str(sensor_id))
+        if not self.enabled or rule is None:
+            return None
+        if value >= rule["target"] - rule["tolerance"]:
+            return None
+        last = self.last_watered.get(str(rule["plant_id"]))
+        if last is not None and (timestamp - last).total_seconds() <= rule["cooldown"]:
+            return None
+        return rule
+
+    def save(self):
+        """Write the rules and watering times to the file, replacing it atomically."""
+        temporary_path = f"{self.path}.tmp"
+        with self._lock:
+            with open(temporary_path, "w") as rules_file:
+                json.dump({
+                    "enabled": self.enabled,
+                    "rules": self.rules,
+                    "last_watered": {plant_id: timestamp.isoformat()
+                                     for plant_id, timestamp in self.last_watered.items()}
+                }, rules_file)
+            os.replace(temporary_path, self.path)
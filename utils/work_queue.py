@@ -0,0 +1,161 @@
+"""Bounded, partitioned worker pool for handling MQTT messages off the network thread."""
+import queue
+import threading
+import time
+import zlib
+
+from utils.logging import mqtt_logger
+
+# Ways to handle a message when its partition's queue is full
+BACKPRESSURE_MODES = ["block", "drop_newest", "drop_oldest"]
+
+
+class partitioned_worker_pool():
+    """Pool of worker threads that each own a bounded FIFO queue.
+
+    Work is assigned to a worker by hashing a partition key, so all work with
+    the same key (for example a sensor_id) is processed in submission order.
+    """
+
+    def __init__(self, workers=4, max_depth=1000, backpressure="block", block_timeout=1.0):
+        """Create the pool and start its worker threads.
+
+        Parameters
+        ----------
+        workers : int
+            Number of worker threads.
+
+        max_depth : int
+            Maximum number of waiting items per worker queue.
+
+        backpressure : str
+            What to do when a queue is full, one of BACKPRESSURE_MODES.
+                block: wait up to block_timeout for space, stalling the caller.
+                drop_newest: discard the item being submitted.
+                drop_oldest: discard the oldest waiting item in the queue.
+
+        block_timeout : float
+            Seconds to wait for space in block mode before dropping the item.
+            Keep it well below the MQTT keepalive when submitting from paho's
+            network thread, None waits forever.
+        """
+        if backpressure not in BACKPRESSURE_MODES:
+            raise ValueError(
+                f"backpressure must be one of {BACKPRESSURE_MODES}, not {backpressure}")
+        self.backpressure = backpressure
+        self.block_timeout = block_timeout
+        self._queues = [queue.Queue(maxsize=max_depth) for _ in range(workers)]
+        self._stats_lock = threading.Lock()
+
+        # Counters exposed through stats()
+        self.submitted = 0
+        self.processed = 0
+        self.failed = 0
+        self.dropped = 0
+        self.max_depth_seen = 0
+        self.total_processing_seconds = 0.0
+        self.max_processing_seconds = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._run, args=(work_queue,),
+                             name=f"worker_{index}", daemon=True)
+            for index, work_queue in enumerate(self._queues)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, key, function, *args):
+        """Queue function(*args) on the worker that owns key.
+
+        Returns
+        -------
+        True if the work was queued, False if it was dropped.
+        """
+        work_queue = self._queues[zlib.crc32(str(key).encode()) % len(self._queues)]
+        item = (key, function, args)
+
+        if self.backpressure == "block":
+            try:
+                work_queue.put(item, timeout=self.block_timeout)
+            except queue.Full:
+                return self._drop(key)
+        elif self.backpressure == "drop_newest":
+            try:
+                work_queue.put_nowait(item)
+            except queue.Full:
+                return self._drop(key)
+        else:
+            while True:
+                try:
+                    work_queue.put_nowait(item)
+                    break
+                except queue.Full:
+                    try:
+                        evicted_key = work_queue.get_nowait()[0]
+                    except queue.Empty:
+                        continue
+                    work_queue.task_done()
+                    self._drop(evicted_key)
+
+        with self._stats_lock:
+            self.submitted += 1
+            self.max_depth_seen = max(self.max_depth_seen, work_queue.qsize())
+        return True
+
+    def join(self):
+        """Block until every queued item has been processed."""
+        for work_queue in self._queues:
+            work_queue.join()
+
+    def stop(self):
+        """Process the remaining work, then stop the worker threads."""
+        for work_queue in self._queues:
+            work_queue.put((None, None, None))
+        for thread in self._threads:
+            thread.join()
+
+    def stats(self):
+        """Return queue depths and processing counters as a dict."""
+        with self._stats_lock:
+            return {
+                "queue_depths": [work_queue.qsize() for work_queue in self._queues],
+                "max_depth_seen": self.max_depth_seen,
+                "submitted": self.submitted,
+                "processed": self.processed,
+                "failed": self.failed,
+                "dropped": self.dropped,
+                "mean_processing_seconds": self.total_processing_seconds / self.processed if self.processed else 0,
+                "max_processing_seconds": self.max_processing_seconds
+            }
+
+    def _drop(self, key):
+        """Count and log a dropped item by its partition key."""
+        with self._stats_lock:
+            self.dropped += 1
+        mqtt_logger.warning(f"Work queue full, dropped message for {key}")
+        return False
+
+    def _run(self, work_queue):
+        """Process items from a single queue until a stop marker is received."""
+        while True:
+            key, function, args = work_queue.get()
+            if function is None:
+                work_queue.task_done()
+                return
+
+            start = time.monotonic()
+            failed = False
+            try:
+                function(*args)
+            except Exception as error:
+                failed = True
+                mqtt_logger.exception(f"Failed to handle message for {key}: {error}")
+            elapsed = time.monotonic() - start
+
+            with self._stats_lock:
+                self.processed += 1
+                self.failed += failed
+                self.total_processing_seconds += elapsed
+                self.max_processing_seconds = max(
+                    self.max_processing_seconds, elapsed)
+            work_queue.task_done()